@@ -78,6 +78,13 @@ class Predictor:
         kwargs["contains_labels"] = contains_labels
         return self.inference.predict(loader, **shallow_copy_dict(kwargs))
 
+    def predict_array(
+        self,
+        x: np.ndarray,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, np_dict_type]:
+        return self.inference.predict_array(x, self.device, **kwargs)
+
     def predict_prob(
         self,
         x: data_type,
@@ -320,6 +320,7 @@ class Elements(NamedTuple):
         kwargs.setdefault("binary_config", {})
         kwargs.setdefault("shuffle_tr", True)
         kwargs.setdefault("cv_batch_size", 512)
+        kwargs.setdefault("cpu_prefetch_depth", 0)
         kwargs.setdefault("ts_label_collator_config", {})
         log_folder = kwargs.setdefault("logging_folder", os.path.join("_logs", model))
         log_file = kwargs.get("logging_file")
@@ -1,4 +1,11 @@
 from .core import *
+from .streaming import *
 
 
-__all__ = ["TabularData", "TabularLoader", "TabularSampler"]
+__all__ = [
+    "TabularData",
+    "MemmapTabularData",
+    "StreamingTabularData",
+    "TabularLoader",
+    "TabularSampler",
+]
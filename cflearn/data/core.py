@@ -1,26 +1,455 @@
+import os
 import copy
 import torch
+import shutil
+import weakref
+import logging
+import tempfile
 
 import numpy as np
 
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Union
+from typing import Callable
+from typing import Optional
+from concurrent.futures import Executor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+from cftool.misc import Saving
 from cftool.misc import update_dict
 from cftool.misc import shallow_copy_dict
 from cfdata.types import np_int_type
 from cfdata.types import np_float_type
+from cfdata.tabular import DataTuple
+from cfdata.tabular import ColumnTypes
 from cfdata.tabular import DataLoader
 from cfdata.tabular import ImbalancedSampler
 from cfdata.tabular import TabularData as TD
+from cfdata.tabular.recognizer import Recognizer
+from cfdata.tabular.converters import Converter
+from cfdata.tabular.processors import Processor
+from cfdata.tabular.processors import processor_dict
 
+from ..types import data_type
 from ..types import loader_batch_type
+from ..protocol import DataSplit
 from ..protocol import DataProtocol
 from ..protocol import SamplerProtocol
 from ..protocol import DataLoaderProtocol
 from ..misc.toolkit import to_torch
 
 
+column_task_type = Tuple[str, np.ndarray, Dict[str, Any], bool]
+
+
+def _fit_column(args: column_task_type) -> Tuple[Recognizer, Optional[Converter]]:
+    column_name, flat_arr, kwargs, convert = args
+    recognizer = Recognizer(column_name, **kwargs)  # type: ignore
+    recognizer.fit(flat_arr)
+    if not convert or not recognizer.info.is_valid:
+        return recognizer, None
+    return recognizer, Converter.make_with(recognizer)
+
+
 @DataProtocol.register("tabular")
 class TabularData(TD, DataProtocol):
-    pass
+    """
+    * If `num_jobs` > 1, the per-column recognition & conversion will be fanned out
+    over a thread pool (or a process pool, if `parallel_backend` is 'process') with
+    `_fit_column`. Processors depend on the previous ones, so they are fitted
+    serially afterwards. Results are gathered in column order, so they are identical
+    to the serial ones.
+    """
+
+    parallel_backends = {"thread", "process"}
+
+    def __init__(
+        self,
+        *,
+        num_jobs: int = 1,
+        parallel_backend: str = "thread",
+        **kwargs: Any,
+    ):
+        if parallel_backend not in self.parallel_backends:
+            backends = sorted(self.parallel_backends)
+            raise ValueError(
+                f"`parallel_backend` should be one of {backends}, "
+                f"'{parallel_backend}' found"
+            )
+        super().__init__(**kwargs)
+        self.num_jobs = num_jobs
+        self.parallel_backend = parallel_backend
+
+    def _map(self, fn: Callable, tasks: List[Any]) -> List[Any]:
+        num_jobs = min(self.num_jobs, len(tasks))
+        if num_jobs <= 1:
+            return list(map(fn, tasks))
+        executor: Executor
+        chunk_size = 1
+        if self.parallel_backend == "thread":
+            executor = ThreadPoolExecutor(num_jobs)
+        else:
+            executor = ProcessPoolExecutor(num_jobs)
+            chunk_size = max(1, len(tasks) // (4 * num_jobs))
+        with executor:
+            return list(executor.map(fn, tasks, chunksize=chunk_size))
+
+    def _column_task(self, i: int, flat_arr: np.ndarray) -> column_task_type:
+        kwargs = {
+            "is_valid": self.prior_valid_columns[i],
+            "is_string": self.prior_string_columns[i],
+            "is_numerical": self.prior_numerical_columns[i],
+            "is_categorical": self.prior_categorical_columns[i],
+            "config": self._recognizer_configs.setdefault(i, {}),
+        }
+        return self.column_names[i], flat_arr, kwargs, i not in self.ts_indices
+
+    def _fit_features(self, features: np.ndarray) -> np.ndarray:
+        tasks = [self._column_task(i, arr) for i, arr in enumerate(features)]
+        results = self._map(_fit_column, tasks)
+        # the last column is forced to be valid if all the previous ones are excluded
+        excludes = set(self.excludes)
+        for i, (recognizer, _) in enumerate(results[:-1]):
+            if not recognizer.info.is_valid:
+                excludes.add(i)
+        if len(excludes) == len(tasks) - 1 and not tasks[-1][2]["is_valid"]:
+            tasks[-1][2]["is_valid"] = True
+            results[-1] = _fit_column(tasks[-1])
+        converted_features = []
+        for i, (recognizer, converter) in enumerate(results):
+            self._recognizers[i] = recognizer
+            if not recognizer.info.is_valid:
+                self.log_msg(
+                    recognizer.info.msg,
+                    self.warning_prefix,
+                    2,
+                    logging.WARNING,
+                )
+                self.excludes.add(i)
+                continue
+            if converter is not None:
+                self._converters[i] = converter
+                converted = converter.converted_input.astype(np_float_type)
+                converted_features.append(converted)
+        return np.vstack(converted_features).T
+
+    def _fit_processors(self, converted_x: np.ndarray) -> np.ndarray:
+        ts_indices = self.ts_indices
+        processed_features = []
+        previous_processors: List[Processor] = []
+        idx = 0
+        while idx < self.raw_dim:
+            if idx in self.excludes or idx in ts_indices:
+                idx += 1
+                continue
+            converter = self._converters[idx]
+            assert converter is not None
+            if self._process_methods is None:
+                method = None
+            elif isinstance(self._process_methods, str):
+                method = self._process_methods
+            else:
+                method = self._process_methods.get(idx, "auto")
+            if method is None:
+                method = "identical"
+            elif method == "auto":
+                if converter.info.column_type is ColumnTypes.NUMERICAL:
+                    method = self._default_numerical_process
+                else:
+                    method = self._default_categorical_process
+            processor = processor_dict[method].make_with(previous_processors.copy())
+            previous_processors.append(processor)
+            self._processors[idx] = processor
+            columns = converted_x[..., processor.input_indices]
+            processor.fit(columns)
+            processed_features.append(processor.process(columns))
+            idx += processor.input_dim
+        return np.hstack(processed_features)
+
+    def _fit_labels(self, label_name: str) -> Tuple[np.ndarray, np.ndarray]:
+        recognizer = self._inject_label_recognizer(label_name)
+        converter = self._converters[-1] = Converter.make_with(recognizer)
+        converted = converter.converted_input.reshape([-1, 1])
+        method = self._label_process_method
+        if method is None:
+            is_numerical = converter.info.column_type is ColumnTypes.NUMERICAL
+            method = "normalize" if is_numerical else "identical"
+        processor = processor_dict[method].make_with([])
+        self._processors[-1] = processor.fit(converted)
+        processed = processor.process(converted)
+        if self.task_type.is_clf:
+            converted = converted.astype(np_int_type)
+            processed = processed.astype(np_int_type)
+        return converted, processed
+
+    def _core_fit(self) -> "TabularData":
+        raw = self.raw
+        if self.num_jobs <= 1 or self._simplify or raw is None or raw.x is None:
+            return super()._core_fit()
+        # `prior_*` columns & `column_names` rely on `raw_dim`
+        self._raw_dim = len(raw.x[0])
+        recognizers: Dict[int, Optional[Recognizer]] = {}
+        converters: Dict[int, Optional[Converter]] = {}
+        processors: Dict[int, Optional[Processor]] = {}
+        self._recognizers, self._converters = recognizers, converters
+        self._processors = processors
+        features = raw.xT
+        assert features is not None
+        converted_x = self._fit_features(features)
+        processed_x = self._fit_processors(converted_x)
+        if raw.y is None:
+            converted_y = processed_y = None
+            self._recognizers[-1] = self._converters[-1] = None
+            self._processors[-1] = None
+        else:
+            label_name = self.label_name or "__label__"
+            converted_y, processed_y = self._fit_labels(label_name)
+        self._converted = DataTuple(converted_x, converted_y)
+        self._processed = DataTuple(processed_x, processed_y)
+        self._valid_columns = [
+            col for col in range(self.raw_dim) if col not in self.excludes
+        ]
+        self.ts_sorting_indices: Optional[np.ndarray] = None
+        if self.is_ts:
+            self._get_ts_sorting_indices()
+        if not self.is_reg and processed_y is not None:
+            self._num_classes = processed_y.max().item() + 1
+        # same as `_core_fit` of `cfdata`, which caches the prior settings
+        _ = self.prior_valid_columns
+        _ = self.prior_string_columns
+        _ = self.prior_categorical_columns
+        _ = self.prior_numerical_columns
+        return self
+
+
+class _MmapFolder:
+    """Removes the temporary folder once no data refers to it anymore."""
+
+    def __init__(self, path: str):
+        self.path = path
+        weakref.finalize(self, shutil.rmtree, path, ignore_errors=True)
+
+
+@DataProtocol.register("tabular_mmap")
+class MemmapTabularData(TabularData):
+    """
+    Keeps `processed.x` & `processed.y` as `.npy` files opened with `np.memmap`,
+    so batches are read from the page cache instead of a private in-memory copy.
+
+    * If `mmap_folder` is not provided, a temporary folder will be used.
+    * The `.npy` files live in temporary sub-folders, which will be removed once the
+    data (and the splits which refer to them) are garbage collected.
+    * Splits are views over the processed arrays if their indices are contiguous,
+    otherwise both of them will view one reordered copy.
+    * `save` writes the processed arrays as standalone `.npy` files, and `load`
+    copies them into a temporary folder before memory-mapping them.
+    """
+
+    mmap_mode = "r"
+    chunk_size = 100000
+    processed_x_file = "processed_x.npy"
+    processed_y_file = "processed_y.npy"
+
+    _mmap_handle: Optional[_MmapFolder] = None
+
+    def __init__(self, *, mmap_folder: Optional[str] = None, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.mmap_folder = mmap_folder
+
+    def _new_mmap_folder(self) -> _MmapFolder:
+        if self.mmap_folder is None:
+            return _MmapFolder(tempfile.mkdtemp(prefix="cflearn_mmap_"))
+        os.makedirs(self.mmap_folder, exist_ok=True)
+        return _MmapFolder(tempfile.mkdtemp(dir=self.mmap_folder))
+
+    def _open_processed(
+        self,
+        folder: str,
+        num_samples: int,
+        x_like: np.ndarray,
+        y_like: Optional[np.ndarray],
+    ) -> Tuple[np.memmap, Optional[np.memmap]]:
+        def _open(file: str, like: np.ndarray) -> np.memmap:
+            return np.lib.format.open_memmap(
+                os.path.join(folder, file),
+                mode="w+",
+                dtype=like.dtype,
+                shape=(num_samples, *like.shape[1:]),
+            )
+
+        x = _open(self.processed_x_file, x_like)
+        y = None if y_like is None else _open(self.processed_y_file, y_like)
+        return x, y
+
+    def _dump_processed(self, folder: str) -> None:
+        processed = self._processed
+        if processed is None or processed.x is None:
+            return None
+        np.save(os.path.join(folder, self.processed_x_file), processed.x)
+        if processed.y is not None:
+            np.save(os.path.join(folder, self.processed_y_file), processed.y)
+
+    def _load_arrays(
+        self,
+        folder: str,
+    ) -> Tuple[Optional[np.ndarray], Optional[np.ndarray]]:
+        def _load(file: str) -> Optional[np.ndarray]:
+            path = os.path.join(folder, file)
+            if not os.path.isfile(path):
+                return None
+            return np.load(path, mmap_mode=self.mmap_mode)  # type: ignore
+
+        return _load(self.processed_x_file), _load(self.processed_y_file)
+
+    def _load_processed(
+        self,
+        folder: str,
+        handle: Optional[_MmapFolder] = None,
+    ) -> None:
+        x, y = self._load_arrays(folder)
+        if x is None:
+            return None
+        self._processed = DataTuple(x, y)
+        self._mmap_handle = handle
+
+    def _to_memmap(self) -> "MemmapTabularData":
+        handle = self._new_mmap_folder()
+        self._dump_processed(handle.path)
+        self._load_processed(handle.path, handle)
+        return self
+
+    @staticmethod
+    def _to_slice(indices: np.ndarray) -> Optional[slice]:
+        start = int(indices[0]) if len(indices) > 0 else 0
+        end = start + len(indices)
+        if not np.array_equal(indices, np.arange(start, end)):
+            return None
+        return slice(start, end)
+
+    def _take(self, indices: np.ndarray) -> _MmapFolder:
+        processed = self._processed
+        if processed is None:
+            raise ValueError("`_processed` data is not generated")
+        x, y = processed.xy
+        handle = self._new_mmap_folder()
+        new_x, new_y = self._open_processed(handle.path, len(indices), x, y)
+        for start in range(0, len(indices), self.chunk_size):
+            end = start + self.chunk_size
+            local_indices = indices[start:end]
+            new_x[start:end] = x[local_indices]
+            if new_y is not None:
+                new_y[start:end] = y[local_indices]
+        new_x.flush()
+        if new_y is not None:
+            new_y.flush()
+        return handle
+
+    def _assign_splits(
+        self,
+        split: "MemmapTabularData",
+        remained: "MemmapTabularData",
+        split_indices: np.ndarray,
+        remained_indices: np.ndarray,
+    ) -> None:
+        processed = self._processed
+        if processed is None:
+            raise ValueError("`_processed` data is not generated")
+        x, y = processed.xy
+        handle = self._mmap_handle
+        split_slice = self._to_slice(split_indices)
+        remained_slice = self._to_slice(remained_indices)
+        if split_slice is None or remained_slice is None:
+            # views can only be sliced, so both splits share one reordered copy
+            num_split = len(split_indices)
+            handle = self._take(np.concatenate([split_indices, remained_indices]))
+            x, y = self._load_arrays(handle.path)
+            assert x is not None
+            split_slice = slice(0, num_split)
+            remained_slice = slice(num_split, num_split + len(remained_indices))
+        for data, data_slice in [(split, split_slice), (remained, remained_slice)]:
+            data_y = None if y is None else y[data_slice]
+            data._processed = DataTuple(x[data_slice], data_y)
+            data._mmap_handle = handle
+
+    def read(
+        self,
+        x: Union[str, data_type],
+        y: Optional[Union[int, data_type]] = None,
+        *,
+        contains_labels: bool = True,
+        **kwargs: Any,
+    ) -> "MemmapTabularData":
+        super().read(x, y, contains_labels=contains_labels, **kwargs)
+        return self._to_memmap()
+
+    def split_with_indices(
+        self,
+        split_indices: np.ndarray,
+        remained_indices: np.ndarray,
+    ) -> DataSplit:
+        split = super().split_with_indices(split_indices, remained_indices)
+        assert isinstance(split.split, MemmapTabularData)
+        assert isinstance(split.remained, MemmapTabularData)
+        self._assign_splits(
+            split.split,
+            split.remained,
+            split_indices,
+            remained_indices,
+        )
+        return split
+
+    def save(
+        self,
+        folder: str,
+        *,
+        compress: bool = True,
+        retain_data: bool = True,
+        remove_original: bool = True,
+    ) -> "MemmapTabularData":
+        if not retain_data:
+            super().save(
+                folder,
+                compress=compress,
+                retain_data=retain_data,
+                remove_original=remove_original,
+            )
+            return self
+        processed = self._processed
+        self._processed = DataTuple(None, None)
+        try:
+            super().save(folder, compress=False, retain_data=True)
+        finally:
+            self._processed = processed
+        self._dump_processed(os.path.abspath(folder))
+        if compress:
+            Saving.compress(os.path.abspath(folder), remove_original=remove_original)
+        return self
+
+    @classmethod
+    def load(
+        cls,
+        folder: str,
+        *,
+        compress: bool = True,
+        verbose_level: int = 0,
+    ) -> "MemmapTabularData":
+        with Saving.compress_loader(folder, compress, remove_extracted=True):
+            data = super().load(folder, compress=False, verbose_level=verbose_level)
+            assert isinstance(data, MemmapTabularData)
+            # `folder` itself may be extracted & removed afterwards (for instance, by
+            # `Pipeline.load`), so the files are copied into a folder owned by `data`
+            x_path = os.path.join(os.path.abspath(folder), cls.processed_x_file)
+            if os.path.isfile(x_path):
+                handle = data._new_mmap_folder()
+                for file in [cls.processed_x_file, cls.processed_y_file]:
+                    path = os.path.join(os.path.abspath(folder), file)
+                    if os.path.isfile(path):
+                        shutil.copyfile(path, os.path.join(handle.path, file))
+                data._load_processed(handle.path, handle)
+        return data
 
 
 @SamplerProtocol.register("tabular")
@@ -30,7 +459,79 @@ class TabularSampler(ImbalancedSampler, SamplerProtocol):
 
 @DataLoaderProtocol.register("tabular")
 class TabularLoader(DataLoader, DataLoaderProtocol):
+    def __init__(
+        self,
+        batch_size: int,
+        sampler: TabularSampler,
+        *,
+        use_tensor_cache: bool = False,
+        **kwargs: Any,
+    ):
+        super().__init__(batch_size, sampler, **kwargs)
+        self._x_cache: Optional[torch.Tensor] = None
+        self._y_cache: Optional[torch.Tensor] = None
+        # siamese batches need the numpy based collation
+        if use_tensor_cache and self._num_siamese == 1:
+            self._init_tensor_cache()
+
+    @property
+    def use_tensor_cache(self) -> bool:
+        return self._x_cache is not None
+
+    def _init_tensor_cache(self) -> None:
+        x, y = self.data.processed.xy
+        x = np.ascontiguousarray(x, dtype=np_float_type)
+        self._x_cache = torch.from_numpy(x)
+        if y is None:
+            self._y_cache = None
+        else:
+            y_dtype = np_int_type if self.data.is_clf else np_float_type
+            y_cache = torch.from_numpy(np.ascontiguousarray(y, dtype=y_dtype))
+            if self.data.is_clf:
+                y_cache = y_cache.to(torch.long)
+            self._y_cache = y_cache
+
+    def _next_from_cache(self) -> loader_batch_type:
+        assert self._x_cache is not None
+        self._cursor += 1
+        if self._cursor == len(self):
+            raise StopIteration
+        if self._indices_in_use is None:
+            raise ValueError("`_indices_in_use` is not yet generated")
+        start = self._cursor * self.batch_size
+        end = start + self.batch_size
+        indices = self._indices_in_use[start:end]
+        # time series caches hold the raw [T, D] rows, and the aggregated indices
+        # ([B, num_history]) gather the windows of the current batch lazily
+        if self.data.is_ts:
+            flat_tensor = torch.from_numpy(indices.ravel().astype(np_int_type))
+            window_shape = *indices.shape, -1
+            x_batch = self._x_cache.index_select(0, flat_tensor).view(window_shape)
+            if self._y_cache is None:
+                labels = None
+            else:
+                labels = self._y_cache.index_select(0, flat_tensor).view(window_shape)
+                if self._label_collator is not None:
+                    labels = self._label_collator(labels)
+        # indices are a plain `arange` when not shuffled, so slicing gives views
+        elif not self.sampler.shuffle:
+            x_batch = self._x_cache[start:end]
+            labels = None if self._y_cache is None else self._y_cache[start:end]
+        else:
+            indices_tensor = torch.from_numpy(indices.astype(np_int_type))
+            x_batch = self._x_cache.index_select(0, indices_tensor)
+            if self._y_cache is None:
+                labels = None
+            else:
+                labels = self._y_cache.index_select(0, indices_tensor)
+        sample = {"x_batch": x_batch, self.labels_key: labels}
+        if not self.return_indices:
+            return sample
+        return sample, indices
+
     def __next__(self) -> loader_batch_type:
+        if self.use_tensor_cache and not self.is_onnx:
+            return self._next_from_cache()
         sample = DataLoader.__next__(self)
         if self.return_indices:
             (x_batch, labels), indices = sample
@@ -66,6 +567,7 @@ class TabularLoader(DataLoader, DataLoaderProtocol):
 
 __all__ = [
     "TabularData",
+    "MemmapTabularData",
     "TabularSampler",
     "TabularLoader",
 ]
@@ -0,0 +1,376 @@
+import os
+import copy
+
+import numpy as np
+
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Tuple
+from typing import Union
+from typing import Iterator
+from typing import Optional
+from cfdata.types import np_int_type
+from cfdata.tabular import DataTuple
+
+from .core import MemmapTabularData
+from ..types import data_type
+from ..protocol import DataSplit
+from ..protocol import DataProtocol
+
+
+rows_type = Union[np.ndarray, List[List[str]]]
+chunk_type = Tuple[rows_type, Optional[rows_type]]
+
+
+# views should not be kept, otherwise the whole chunk will be kept alive
+def _copy(rows: Any) -> Any:
+    if isinstance(rows, np.ndarray):
+        return rows.copy()
+    return rows
+
+
+def _label_key(row: Any) -> Any:
+    if isinstance(row, list):
+        return row[0]
+    return np.asarray(row).ravel()[:1].tolist()[0]
+
+
+@DataProtocol.register("tabular_stream")
+class StreamingTabularData(MemmapTabularData):
+    """
+    Reads csv / txt / npy sources in chunks of `chunk_size` rows, so the whole
+    dataset never needs to fit into memory.
+
+    * The first pass draws a reservoir sample (at most `fit_size` rows), on which
+    the recognizers, converters & processors are fitted.
+    * The second pass transforms each chunk and writes it into the
+    memory-mapped processed `.npy` files, which `TabularLoader` iterates over.
+
+    Notes
+    -----
+    * `raw` & `converted` only hold the reservoir sample.
+    * Categories that are absent from the sample will be treated as unseen values.
+    * The first row of each label value is injected into the sample if the label is
+    absent from it, so every class is fitted. This is skipped once there are more
+    than `max_tracked_labels` label values (e.g. regression labels).
+    * Time series tasks are not supported.
+    """
+
+    max_tracked_labels = 1000
+
+    def __init__(
+        self,
+        *,
+        chunk_size: int = 100000,
+        fit_size: Optional[int] = 100000,
+        seed: int = 142857,
+        mmap_folder: Optional[str] = None,
+        **kwargs: Any,
+    ):
+        super().__init__(mmap_folder=mmap_folder, **kwargs)
+        self.chunk_size = chunk_size
+        self.fit_size = fit_size
+        self.seed = seed
+
+    # chunks
+
+    def _iter_file_chunks(
+        self,
+        file_path: str,
+        *,
+        contains_labels: bool,
+        label_idx: Optional[int] = None,
+        has_column_names: Optional[bool] = None,
+        quote_char: Optional[str] = None,
+        delim: Optional[str] = None,
+    ) -> Iterator[chunk_type]:
+        ext = os.path.splitext(file_path)[1][1:]
+        defaults: Tuple[bool, str, Optional[str]]
+        if ext == "txt":
+            defaults = False, " ", None
+        elif ext == "csv":
+            defaults = True, ",", '"'
+        else:
+            defaults = False, ",", '"'
+        default_has_column_names, default_delim, default_quote_char = defaults
+        if has_column_names is None:
+            has_column_names = default_has_column_names
+        if delim is None:
+            delim = default_delim
+        if quote_char is None:
+            quote_char = default_quote_char
+        self._has_column_names = has_column_names
+        self._delim, self._quote_char = delim, quote_char
+        with open(file_path, "r") as f:
+            if has_column_names:
+                while True:
+                    column_names = self._read_line(f.readline())
+                    if column_names is not None:
+                        break
+                self._column_names = {i: name for i, name in enumerate(column_names)}
+            if not contains_labels:
+                label_idx = None
+            elif self._column_names is not None and self.label_name is not None:
+                reverse_column_names = {v: k for k, v in self._column_names.items()}
+                label_idx = reverse_column_names.get(self.label_name)
+                if label_idx is None:
+                    raise ValueError(
+                        f"'{self.label_name}' is not included in column names "
+                        f"({list(self._column_names.values())})"
+                    )
+            elif label_idx is None:
+                label_idx = -1
+            rows: List[List[str]] = []
+            for line in f:
+                elements = self._read_line(line)
+                if elements is None:
+                    continue
+                rows.append(elements)
+                if len(rows) == self.chunk_size:
+                    yield self._split_labels(rows, label_idx)
+                    rows = []
+            if rows:
+                yield self._split_labels(rows, label_idx)
+
+    def _split_labels(
+        self,
+        rows: List[List[str]],
+        label_idx: Optional[int],
+    ) -> chunk_type:
+        if label_idx is None:
+            return rows, None
+        if label_idx < 0:
+            label_idx += len(rows[0])
+        self._label_idx = label_idx
+        x = [row[:label_idx] + row[label_idx + 1 :] for row in rows]
+        y = [row[label_idx : label_idx + 1] for row in rows]
+        return x, y
+
+    def _iter_chunks(
+        self,
+        x: Union[str, data_type],
+        y: Optional[Union[int, data_type]],
+        contains_labels: bool,
+        **kwargs: Any,
+    ) -> Iterator[chunk_type]:
+        if isinstance(x, str) and not x.endswith(".npy"):
+            if y is not None and not isinstance(y, int):
+                raise ValueError(
+                    "`y` should be integer when `x` is a file. "
+                    "In this case, `y` indicates the index of the label column."
+                )
+            yield from self._iter_file_chunks(
+                x,
+                contains_labels=contains_labels,
+                label_idx=y,
+                **kwargs,
+            )
+            return None
+        if isinstance(y, int):
+            raise ValueError("`y` should not be integer when `x` is not a file")
+        if isinstance(x, str):
+            x = np.load(x, mmap_mode="r")
+        if isinstance(y, str):
+            y = np.load(y, mmap_mode="r")
+        if not isinstance(x, np.ndarray):
+            x = np.asarray(x)
+        if y is not None and not isinstance(y, np.ndarray):
+            y = np.asarray(y)
+        for start in range(0, len(x), self.chunk_size):
+            end = start + self.chunk_size
+            yield x[start:end], None if y is None else y[start:end]
+
+    def _track_labels(
+        self,
+        x: Any,
+        y: Any,
+        label_rows: Dict[Any, Tuple[Any, Any]],
+    ) -> Optional[Dict[Any, Tuple[Any, Any]]]:
+        if isinstance(y, np.ndarray):
+            labels, first_indices = np.unique(
+                y.reshape([len(y), -1])[..., 0],
+                return_index=True,
+            )
+            pairs = zip(labels.tolist(), first_indices.tolist())
+        else:
+            pairs = ((row[0], i) for i, row in enumerate(y))
+        for label, idx in pairs:
+            if label not in label_rows:
+                label_rows[label] = _copy(x[idx]), _copy(y[idx])
+                if len(label_rows) > self.max_tracked_labels:
+                    return None
+        return label_rows
+
+    def _reservoir_sample(
+        self,
+        chunks: Iterator[chunk_type],
+    ) -> Tuple[int, List[Any], Optional[List[Any]]]:
+        random_state = np.random.RandomState(self.seed)
+        sample_x: List[Any] = []
+        sample_y: Optional[List[Any]] = None
+        label_rows: Optional[Dict[Any, Tuple[Any, Any]]] = {}
+        num_samples = 0
+        for x, y in chunks:
+            if y is not None and sample_y is None:
+                sample_y = []
+            num_chunk = len(x)
+            if y is not None and label_rows is not None and self.fit_size is not None:
+                label_rows = self._track_labels(x, y, label_rows)
+            if self.fit_size is None:
+                sample_x.extend(x)
+                if sample_y is not None:
+                    sample_y.extend(y)  # type: ignore
+                num_samples += num_chunk
+                continue
+            # fill the reservoir first
+            num_fill = max(0, min(num_chunk, self.fit_size - num_samples))
+            sample_x.extend(_copy(x[:num_fill]))
+            if sample_y is not None:
+                sample_y.extend(_copy(y[:num_fill]))  # type: ignore
+            # then replace with decreasing probabilities (Algorithm R)
+            if num_fill < num_chunk:
+                start, end = num_samples + num_fill, num_samples + num_chunk
+                targets = np.asarray(random_state.randint(0, np.arange(start, end) + 1))
+                for i in np.nonzero(targets < self.fit_size)[0]:
+                    local_idx = num_fill + i
+                    sample_x[targets[i]] = _copy(x[local_idx])
+                    if sample_y is not None:
+                        sample_y[targets[i]] = _copy(y[local_idx])  # type: ignore
+            num_samples += num_chunk
+        # classes which are absent from the reservoir are injected back, otherwise
+        # they could not be recognized by the fitted label converter
+        if sample_y is not None and label_rows:
+            sampled_labels = set(map(_label_key, sample_y))
+            for label, (x_row, y_row) in label_rows.items():
+                if label not in sampled_labels:
+                    sample_x.append(x_row)
+                    sample_y.append(y_row)
+        return num_samples, sample_x, sample_y
+
+    # API
+
+    def read(
+        self,
+        x: Union[str, data_type],
+        y: Optional[Union[int, data_type]] = None,
+        *,
+        contains_labels: bool = True,
+        **kwargs: Any,
+    ) -> "StreamingTabularData":
+        # pass 1 : fit data structures on the reservoir sample
+        chunks = self._iter_chunks(x, y, contains_labels, **kwargs)
+        num_samples, sample_x, sample_y = self._reservoir_sample(chunks)
+        if not sample_x:
+            raise ValueError("no data is read from the given source")
+        is_file = isinstance(x, str) and not x.endswith(".npy")
+        if not is_file:
+            sample_x = np.stack(sample_x)  # type: ignore
+            if sample_y is not None:
+                sample_y = np.stack(sample_y)  # type: ignore
+        super(MemmapTabularData, self).read(sample_x, sample_y)
+        if self.is_ts:
+            raise ValueError("time series tasks are not supported in streaming mode")
+        if is_file:
+            self._is_file, self._is_arr = True, False
+        # pass 2 : transform chunks into the memory-mapped processed data
+        assert self._processed is not None
+        handle = self._new_mmap_folder()
+        processed_x, processed_y = self._open_processed(
+            handle.path,
+            num_samples,
+            *self._processed.xy,
+        )
+        cursor = 0
+        for x_chunk, y_chunk in self._iter_chunks(x, y, contains_labels, **kwargs):
+            raw = DataTuple.with_transpose(x_chunk, y_chunk)
+            _, transformed = self._transform(raw)
+            end = cursor + len(transformed.x)
+            processed_x[cursor:end] = transformed.x
+            if processed_y is not None:
+                if self.is_clf and transformed.y.max().item() >= self._num_classes:
+                    raise ValueError(
+                        "classes which are absent from the fitted sample are found, "
+                        "please increase `fit_size` or `max_tracked_labels`"
+                    )
+                processed_y[cursor:end] = transformed.y
+            cursor = end
+        processed_x.flush()
+        if processed_y is not None:
+            processed_y.flush()
+        self._load_processed(handle.path, handle)
+        self.ts_sorting_indices = np.arange(num_samples)
+        return self
+
+    @staticmethod
+    def _pick_every_class(sorted_labels: np.ndarray, is_split: np.ndarray) -> None:
+        # evenly spaced picks may skip rare classes (e.g. those with one sample), so
+        # they take the places of the picks of the most picked classes. Otherwise
+        # metrics like auc would fail on the split
+        starts = np.flatnonzero(np.r_[True, sorted_labels[1:] != sorted_labels[:-1]])
+        ends = np.r_[starts[1:], len(sorted_labels)]
+        num_picked = np.add.reduceat(is_split.astype(np_int_type), starts)
+        for i in np.flatnonzero(num_picked == 0):
+            donor = int(np.argmax(num_picked))
+            if num_picked[donor] <= 1:
+                break
+            donor_picked = np.flatnonzero(is_split[starts[donor] : ends[donor]])
+            is_split[starts[donor] + donor_picked[-1]] = False
+            is_split[starts[i]] = True
+            num_picked[donor] -= 1
+            num_picked[i] += 1
+
+    def _auto_split_indices(self, num: int) -> Tuple[np.ndarray, np.ndarray]:
+        num_samples = len(self)
+        permutation = np.random.RandomState(self.seed).permutation(num_samples)
+        is_split = np.zeros(num_samples, dtype=bool)
+        is_split[(np.arange(num) * num_samples) // max(num, 1)] = True
+        processed = self._processed
+        if self.is_clf and processed is not None and processed.y is not None:
+            # stratified : picking evenly from the label-sorted permutation keeps
+            # the class ratios of the full data in both splits
+            labels = np.asarray(processed.y).ravel()[permutation]
+            sorted_indices = np.argsort(labels, kind="stable")
+            permutation = permutation[sorted_indices]
+            if 0 < num < num_samples:
+                self._pick_every_class(labels[sorted_indices], is_split)
+        split_indices = np.sort(permutation[is_split])
+        remained_indices = np.sort(permutation[~is_split])
+        return split_indices, remained_indices
+
+    def split(self, n: Union[int, float], *, order: str = "auto") -> DataSplit:
+        # `raw` only holds the reservoir sample, so `len(self)` should be used here
+        if order not in {"auto", "bottom_up", "top_down"}:
+            raise NotImplementedError(
+                "`order` should be either 'auto', 'bottom_up' or "
+                f"'top_down', {order} found"
+            )
+        num_samples = len(self)
+        num = n if isinstance(n, int) else int(round(n * num_samples))
+        base_indices = np.arange(num_samples)
+        if order == "auto":
+            split_indices, remained_indices = self._auto_split_indices(num)
+        elif order == "bottom_up":
+            split_indices = base_indices[-num:]
+            remained_indices = base_indices[:-num]
+        else:
+            split_indices = base_indices[:num]
+            remained_indices = base_indices[num:]
+        return self.split_with_indices(split_indices, remained_indices)
+
+    def split_with_indices(
+        self,
+        split_indices: np.ndarray,
+        remained_indices: np.ndarray,
+    ) -> DataSplit:
+        p1 = copy.copy(self)
+        p2 = copy.copy(self)
+        self._assign_splits(p1, p2, split_indices, remained_indices)
+        p1.ts_sorting_indices = np.arange(len(p1))
+        p2.ts_sorting_indices = np.arange(len(p2))
+        return DataSplit(p1, p2, split_indices, remained_indices)
+
+
+__all__ = [
+    "StreamingTabularData",
+]
@@ -5,28 +5,100 @@ import torch
 import numpy as np
 
 from typing import *
+from itertools import repeat
 from onnxruntime import InferenceSession
 from cftool.misc import shallow_copy_dict
 from cftool.misc import lock_manager
 from cftool.misc import Saving
+from cfdata.types import np_int_type
+from cfdata.types import np_float_type
+from cfdata.tabular import DataTuple
 
 from .types import data_type
 from .types import np_dict_type
+from .types import tensor_dict_type
 from .protocol import DataProtocol
 from .protocol import PrefetchLoader
 from .protocol import SamplerProtocol
+from .protocol import InferenceOutputs
 from .protocol import InferenceProtocol
 from .protocol import DataLoaderProtocol
+from .misc.toolkit import to_numpy
+from .misc.toolkit import to_torch
 from .misc.toolkit import to_standard
 from .misc.toolkit import eval_context
 from .misc.toolkit import LoggingMixinWithRank
 from .models.base import ModelBase
 
 
+class TransformTable:
+    """
+    Vectorized version of the `transform_dict` of a categorical / string converter.
+
+    * numerical keys are sorted, so the column is converted with one `searchsorted`.
+    * string keys are converted through a hash table in one `np.fromiter` pass.
+    """
+
+    def __init__(
+        self,
+        keys: np.ndarray,
+        values: np.ndarray,
+        nan_value: int,
+        oob_value: int,
+    ):
+        self.keys = keys
+        self.values = values
+        self.nan_value = nan_value
+        self.oob_value = oob_value
+        self.is_string = keys.dtype.kind in {"U", "S", "O"}
+        self._lookup: Optional[Dict[str, int]] = None
+        if self.is_string:
+            self._lookup = dict(zip(keys.tolist(), values.tolist()))
+
+    def convert(self, flat_arr: Union[np.ndarray, List[Any]]) -> np.ndarray:
+        if self._lookup is not None:
+            return np.fromiter(
+                map(self._lookup.get, flat_arr, repeat(self.oob_value)),
+                np_float_type,
+                len(flat_arr),
+            )
+        # converters look up float32 values, so we need to align with them
+        arr = np.asarray(flat_arr, np_float_type).astype(self.keys.dtype)
+        indices = np.searchsorted(self.keys, arr)
+        np.minimum(indices, len(self.keys) - 1, out=indices)
+        found = self.keys[indices] == arr
+        converted = np.where(found, self.values[indices], self.oob_value)
+        converted[np.isnan(arr)] = self.nan_value
+        return converted.astype(np_float_type)
+
+    @classmethod
+    def compile(cls, converter: Any) -> Optional["TransformTable"]:
+        identifier = getattr(converter, "__identifier__", None)
+        if identifier not in {"categorical", "string"}:
+            return None
+        if not converter.info.need_transform:
+            return None
+        transform_dict = converter._transform_dict
+        if identifier == "string":
+            nan_value = oob_value = 0
+            items = list(transform_dict.items())
+        else:
+            nan_value = transform_dict.get("nan", 0)
+            oob_value = nan_value if converter.info.need_truncate else 0
+            items = [(k, v) for k, v in transform_dict.items() if k != "nan"]
+        if not items:
+            return None
+        items = sorted(items, key=lambda kv: kv[0])
+        keys = np.array([k for k, _ in items])
+        values = np.array([v for _, v in items], np_int_type)
+        return cls(keys, values, nan_value, oob_value)
+
+
 class PreProcessor(LoggingMixinWithRank):
     data_folder = "data"
     protocols_file = "protocols.json"
     sampler_config_name = "sampler_config"
+    transform_tables_file = "transform_tables.npz"
 
     def __init__(
         self,
@@ -40,6 +112,55 @@ class PreProcessor(LoggingMixinWithRank):
         self.loader_protocol = loader_protocol
         self.sampler_protocol = sampler_protocol
         self.sampler_config = sampler_config
+        self._transform_tables: Optional[Dict[int, TransformTable]] = None
+
+    @property
+    def transform_tables(self) -> Dict[int, TransformTable]:
+        if self._transform_tables is None:
+            tables = {}
+            if not self.data.is_simplify:
+                for idx, converter in self.data.converters.items():
+                    if idx == -1 or converter is None:
+                        continue
+                    table = TransformTable.compile(converter)
+                    if table is not None:
+                        tables[idx] = table
+            self._transform_tables = tables
+        return self._transform_tables
+
+    def transform_features(self, x: np.ndarray) -> np.ndarray:
+        # mirrors the feature part of `TabularData._transform`, with categorical
+        # columns converted through the compiled `transform_tables`
+        data = self.data
+        if data.is_simplify:
+            return x
+        features = DataTuple.with_transpose(x, None).xT
+        tables = self.transform_tables
+        ts_indices = data.ts_indices
+        converted_list = []
+        for i, flat_arr in enumerate(features):
+            if i in data.excludes or i in ts_indices:
+                continue
+            table = tables.get(i)
+            if table is not None:
+                converted_list.append(table.convert(flat_arr))
+            else:
+                converter = data.converters[i]
+                assert converter is not None
+                converted_list.append(converter.convert(flat_arr))
+        converted = np.vstack(converted_list)
+        idx = 0
+        processed = []
+        while idx < data.raw_dim:
+            if idx in data.excludes or idx in ts_indices:
+                idx += 1
+                continue
+            processor = data.processors[idx]
+            assert processor is not None
+            columns = processor.process(converted[processor.input_indices].T)
+            processed.append(columns)
+            idx += processor.input_dim
+        return np.hstack(processed)
 
     def make_sampler(
         self,
@@ -60,6 +181,7 @@ class PreProcessor(LoggingMixinWithRank):
         *,
         is_onnx: bool,
         contains_labels: bool = False,
+        cpu_prefetch_depth: int = 0,
     ) -> PrefetchLoader:
         data = self.data.copy_to(x, None, contains_labels=contains_labels)
         loader = DataLoaderProtocol.make(
@@ -67,7 +189,31 @@ class PreProcessor(LoggingMixinWithRank):
             batch_size,
             self.make_sampler(data, False),
         )
-        return PrefetchLoader(loader, device, is_onnx=is_onnx)
+        return PrefetchLoader(
+            loader,
+            device,
+            is_onnx=is_onnx,
+            cpu_prefetch_depth=cpu_prefetch_depth,
+        )
+
+    def make_inference_batch(
+        self,
+        x: np.ndarray,
+        device: Union[str, torch.device],
+        *,
+        is_onnx: bool,
+    ) -> Union[np_dict_type, tensor_dict_type]:
+        # bypasses `copy_to` & the loaders, only the fitted transforms are applied
+        if self.data.is_ts:
+            raise ValueError("time series data should be predicted with loaders")
+        x_batch = self.transform_features(x).astype(np_float_type, copy=False)
+        if is_onnx:
+            labels = np.zeros([len(x_batch), 1], np_int_type)
+            return {"x_batch": x_batch, DataLoaderProtocol.labels_key: labels}
+        return {
+            "x_batch": to_torch(x_batch).to(device),
+            DataLoaderProtocol.labels_key: None,
+        }
 
     def save(
         self,
@@ -103,6 +249,14 @@ class PreProcessor(LoggingMixinWithRank):
                 self.sampler_config_name,
                 export_folder,
             )
+            tables_arrays = {}
+            for idx, table in self.transform_tables.items():
+                tables_arrays[f"{idx}_keys"] = table.keys
+                tables_arrays[f"{idx}_values"] = table.values
+                meta = [table.nan_value, table.oob_value]
+                tables_arrays[f"{idx}_meta"] = np.array(meta, np_int_type)
+            tables_path = os.path.join(export_folder, self.transform_tables_file)
+            np.savez(tables_path, **tables_arrays)
             if compress:
                 Saving.compress(abs_folder, remove_original=remove_original)
         return self
@@ -132,7 +286,25 @@ class PreProcessor(LoggingMixinWithRank):
                     data_base = DataProtocol.get(data_protocol)
                     data = data_base.load(data_folder, compress=False)
                 sampler_cfg = Saving.load_dict(cls.sampler_config_name, export_folder)
-        return cls(data, loader_protocol, sampler_protocol, sampler_cfg)
+                preprocessor = cls(data, loader_protocol, sampler_protocol, sampler_cfg)
+                tables_path = os.path.join(export_folder, cls.transform_tables_file)
+                if os.path.isfile(tables_path):
+                    tables = {}
+                    with np.load(tables_path) as tables_arrays:
+                        for key in tables_arrays.files:
+                            idx_str, suffix = key.split("_")
+                            if suffix != "meta":
+                                continue
+                            idx = int(idx_str)
+                            nan_value, oob_value = tables_arrays[key].tolist()
+                            tables[idx] = TransformTable(
+                                tables_arrays[f"{idx}_keys"],
+                                tables_arrays[f"{idx}_values"],
+                                nan_value,
+                                oob_value,
+                            )
+                    preprocessor._transform_tables = tables
+        return preprocessor
 
 
 class ONNX:
@@ -265,8 +437,73 @@ class Inference(InferenceProtocol, LoggingMixinWithRank):
         self.binary_metric = config.get("binary_metric")
         self.binary_threshold = config.get("binary_threshold")
 
+    def predict_array(
+        self,
+        x: np.ndarray,
+        device: Union[str, torch.device] = "cpu",
+        *,
+        return_all: bool = False,
+        requires_recover: bool = True,
+        returns_probabilities: bool = False,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, np_dict_type]:
+        batch = self.preprocessor.make_inference_batch(
+            x,
+            device,
+            is_onnx=self.onnx is not None,
+        )
+        if self.onnx is not None:
+            results = self.onnx.inference(batch)
+        else:
+            assert self.model is not None
+            with eval_context(self.model, use_grad=self.use_grad_in_predict):
+                outputs = self.model(batch, **shallow_copy_dict(kwargs))
+            results = {k: to_numpy(v) for k, v in outputs.items() if v is not None}
+        return self.predict_from_outputs(
+            InferenceOutputs(results, None, None, None),
+            return_all,
+            requires_recover,
+            returns_probabilities,
+            **shallow_copy_dict(kwargs),
+        )
+
+    def predict_next(
+        self,
+        x: np.ndarray,
+        device: Union[str, torch.device] = "cpu",
+        series_ids: Optional[Sequence[Hashable]] = None,
+        *,
+        return_all: bool = False,
+        requires_recover: bool = True,
+        returns_probabilities: bool = False,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, np_dict_type]:
+        if self.onnx is not None or self.model is None:
+            raise ValueError("`predict_next` is not supported by onnx")
+        x_step = self.preprocessor.transform_features(x)
+        x_step = x_step.astype(np_float_type, copy=False)
+        with eval_context(self.model, use_grad=self.use_grad_in_predict):
+            outputs = self.model.predict_next(
+                to_torch(x_step).to(device),
+                series_ids,
+                **shallow_copy_dict(kwargs),
+            )
+        results = {k: to_numpy(v) for k, v in outputs.items() if v is not None}
+        return self.predict_from_outputs(
+            InferenceOutputs(results, None, None, None),
+            return_all,
+            requires_recover,
+            returns_probabilities,
+            **shallow_copy_dict(kwargs),
+        )
+
+    def reset_stream(self) -> None:
+        if self.model is not None:
+            self.model.reset_stream()
+
 
 __all__ = [
+    "TransformTable",
     "PreProcessor",
     "ONNX",
     "Inference",
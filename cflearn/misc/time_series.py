@@ -1,13 +1,19 @@
+import torch
+
 import numpy as np
 
 from typing import *
-from cftool.ml import EnsemblePattern
 
 from ..protocol import DataProtocol
 
 
+arr_type = Union[np.ndarray, torch.Tensor]
+
+
 class TSLabelCollator:
     custom_methods: Dict[str, Callable[[np.ndarray], np.ndarray]] = {}
+    # custom methods which could also handle (on device) `torch.Tensor` batches
+    vectorized_methods: Set[str] = set()
 
     def __init__(
         self,
@@ -19,7 +25,10 @@ class TSLabelCollator:
             config = {}
         self._init_config(config)
 
-    def __call__(self, labels: np.ndarray) -> np.ndarray:
+    def __call__(self, labels: arr_type) -> arr_type:
+        if isinstance(labels, torch.Tensor) and not self.vectorized:
+            collated = self.fn(labels.cpu().numpy())
+            return torch.from_numpy(collated).to(labels.device)
         return self.fn(labels)
 
     def _init_config(self, config: Dict[str, Any]) -> None:
@@ -28,23 +37,61 @@ class TSLabelCollator:
         if self._method == "average":
             config.setdefault("num_history", 1)
 
+    @classmethod
+    def register(
+        cls,
+        name: str,
+        *,
+        vectorized: bool = False,
+    ) -> Callable[[Callable], Callable]:
+        def _register(fn: Callable) -> Callable:
+            cls.custom_methods[name] = fn
+            if vectorized:
+                cls.vectorized_methods.add(name)
+            else:
+                cls.vectorized_methods.discard(name)
+            return fn
+
+        return _register
+
     @property
-    def fn(self) -> Callable[[np.ndarray], np.ndarray]:
+    def vectorized(self) -> bool:
+        if self._method in TSLabelCollator.custom_methods:
+            return self._method in TSLabelCollator.vectorized_methods
+        return True
+
+    @property
+    def fn(self) -> Callable[..., arr_type]:
         custom_method = TSLabelCollator.custom_methods.get(self._method)
         if custom_method is not None:
             return custom_method
         return getattr(self, f"_{self._method}")
 
     @staticmethod
-    def _last(labels: np.ndarray) -> np.ndarray:
+    def vote(labels: arr_type, num_classes: int) -> arr_type:
+        # [B, N] -> [B, 1], ties are broken by the smallest label
+        num_samples = labels.shape[0]
+        if isinstance(labels, torch.Tensor):
+            labels = labels.to(torch.long)
+            counts = labels.new_zeros(num_samples, num_classes)
+            counts.scatter_add_(1, labels, torch.ones_like(labels))
+            return counts.argmax(1, keepdim=True)
+        offsets = np.arange(num_samples)[..., None] * num_classes
+        flat = (labels.astype(np.int64) + offsets).ravel()
+        bin_counts = np.bincount(flat, minlength=num_samples * num_classes)
+        bin_counts = bin_counts.reshape([num_samples, num_classes])
+        return bin_counts.argmax(1)[..., None].astype(labels.dtype)
+
+    @staticmethod
+    def _last(labels: arr_type) -> arr_type:
         return labels[..., -1, :]
 
-    def _average(self, labels: np.ndarray) -> np.ndarray:
+    def _average(self, labels: arr_type) -> arr_type:
         num_history = self.config["num_history"]
         extracted = labels[..., -num_history:, :]
         if self.data.is_reg:
-            return extracted.mean(axis=1)
-        return EnsemblePattern.vote(extracted.squeeze(2), self.data.num_classes)
+            return extracted.mean(1)
+        return self.vote(extracted[..., 0], self.data.num_classes)
 
 
 __all__ = ["TSLabelCollator"]
@@ -64,6 +64,16 @@ def to_2d(arr: data_type) -> data_type:
     return [[elem] for elem in arr]
 
 
+def to_column_slice(columns: Union[Sequence[int], np.ndarray]) -> Optional[slice]:
+    if len(columns) == 0:
+        return None
+    start = int(columns[0])
+    end = start + len(columns)
+    if any(int(column) != i for i, column in enumerate(columns, start)):
+        return None
+    return slice(start, end)
+
+
 def to_prob(raw: np.ndarray) -> np.ndarray:
     return nn.functional.softmax(torch.from_numpy(raw), dim=1).numpy()
 
@@ -682,6 +692,7 @@ __all__ = [
     "to_torch",
     "to_numpy",
     "to_2d",
+    "to_column_slice",
     "to_prob",
     "collate_np_dicts",
     "collate_tensor_dicts",
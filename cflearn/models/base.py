@@ -1,9 +1,12 @@
 import torch
+import logging
+import collections
 
 import numpy as np
 
 from typing import *
 from abc import ABCMeta
+from concurrent.futures import ThreadPoolExecutor
 from torch import Tensor
 from torch.nn import Module
 from torch.nn import ModuleDict
@@ -28,6 +31,8 @@ from ..protocol import TrainerState
 from ..protocol import ModelProtocol
 from ..protocol import DataLoaderProtocol
 from ..misc.toolkit import to_torch
+from ..misc.toolkit import eval_context
+from ..misc.toolkit import amp_autocast_context
 from ..modules.heads import HeadBase
 from ..modules.heads import HeadConfigs
 from ..modules.blocks import DNDF
@@ -221,6 +226,14 @@ class ModelBase(ModelProtocol, metaclass=ABCMeta):
         # caches
         self._transform_cache: Dict[str, Tensor] = {}
         self._extractor_cache: Dict[str, Tensor] = {}
+        # [ bool | int ], an int will be the maximum number of threads
+        self._parallel_execute = self.config.setdefault("parallel_execute", False)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_threads = 0
+        # streaming, states are kept per series id
+        self._stream_states: "collections.OrderedDict[Hashable, Dict[str, Any]]"
+        self._stream_states = collections.OrderedDict()
+        self._stream_capacity = self.config.setdefault("stream_capacity", 10000)
 
     def __getattr__(self, item: str) -> Any:
         try:
@@ -462,43 +475,194 @@ class ModelBase(ModelProtocol, metaclass=ABCMeta):
         extract_kwargs_dict: Optional[Dict[str, Dict[str, Any]]] = None,
         head_kwargs_dict: Optional[Dict[str, Dict[str, Any]]] = None,
     ) -> tensor_dict_type:
-        results: Dict[str, Tensor] = {}
-        for key, (transform_key, extractor_key, _) in self.pipes.items():
-            if key in self.bypassed_pipes:
-                continue
-            # transform
-            transformed = self._transform_cache.get(transform_key)
-            if transformed is None:
-                transform = self.transforms[transform_key]
-                transformed = net if isinstance(net, Tensor) else transform(net)
-                self._transform_cache[transform_key] = transformed
-            # extract
-            if extract_kwargs_dict is None:
-                extract_kwargs_dict = {}
-            extracted = self._extractor_cache.get(extractor_key)
-            if extracted is None:
-                extractor = self.extractors[extractor_key]
-                extract_kwargs = extract_kwargs_dict.get(extractor_key, {})
-                extracted = extractor(transformed, **extract_kwargs)
-                extracted_shape = extracted.shape
-                if extractor.flatten_ts:
-                    if len(extracted_shape) == 3:
-                        extracted = extracted.view(extracted_shape[0], -1)
-                self._extractor_cache[extractor_key] = extracted
-            # execute
-            if head_kwargs_dict is None:
-                head_kwargs_dict = {}
-            head_kwargs = head_kwargs_dict.get(key, {})
-            results[key] = self.heads[key](extracted, **head_kwargs)
+        if extract_kwargs_dict is None:
+            extract_kwargs_dict = {}
+        if head_kwargs_dict is None:
+            head_kwargs_dict = {}
+        # pipes sharing the same extractor form a branch, and branches are independent
+        keys = [key for key in self.pipes if key not in self.bypassed_pipes]
+        branches: Dict[str, List[str]] = {}
+        for key in keys:
+            branches.setdefault(self.pipes[key][1], []).append(key)
+        args = net, extract_kwargs_dict, head_kwargs_dict
+        if not self._parallel_execute or len(branches) <= 1:
+            results = {key: self._execute_pipe(key, *args) for key in keys}
+        else:
+            for key in keys:
+                self._transform(net, self.pipes[key][0])
+            # grad mode & autocast states are thread local
+            grad_enabled = torch.is_grad_enabled()
+            use_amp = torch.is_autocast_enabled()
+
+            def _run(branch: List[str]) -> List[Tuple[str, Tensor]]:
+                with torch.set_grad_enabled(grad_enabled):
+                    with amp_autocast_context(use_amp):
+                        return [(key, self._execute_pipe(key, *args)) for key in branch]
+
+            num_threads = len(branches)
+            if not isinstance(self._parallel_execute, bool):
+                num_threads = min(num_threads, self._parallel_execute)
+            executor = self._get_executor(num_threads)
+            branch_results: Dict[str, Tensor] = {}
+            for outputs in executor.map(_run, branches.values()):
+                branch_results.update(outputs)
+            results = {key: branch_results[key] for key in keys}
         # finalize
         if clear_cache:
             self.clear_execute_cache()
         return results
 
+    def _get_executor(self, num_threads: int) -> ThreadPoolExecutor:
+        executor = self._executor
+        if executor is None or self._executor_threads != num_threads:
+            self.shutdown_executor()
+            executor = self._executor = ThreadPoolExecutor(num_threads)
+            self._executor_threads = num_threads
+        return executor
+
+    def shutdown_executor(self) -> None:
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown(wait=False)
+            self._executor = None
+
+    def __del__(self) -> None:
+        self.shutdown_executor()
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # thread pools cannot be pickled (or deep-copied), they are created lazily
+        state = self.__dict__.copy()
+        state["_executor"] = None
+        return state
+
+    def _transform(
+        self,
+        net: Union[Tensor, SplitFeatures],
+        transform_key: str,
+    ) -> Tensor:
+        transformed = self._transform_cache.get(transform_key)
+        if transformed is None:
+            transform = self.transforms[transform_key]
+            transformed = net if isinstance(net, Tensor) else transform(net)
+            self._transform_cache[transform_key] = transformed
+        return transformed
+
+    def _execute_pipe(
+        self,
+        key: str,
+        net: Union[Tensor, SplitFeatures],
+        extract_kwargs_dict: Dict[str, Dict[str, Any]],
+        head_kwargs_dict: Dict[str, Dict[str, Any]],
+    ) -> Tensor:
+        transform_key, extractor_key, _ = self.pipes[key]
+        # transform
+        transformed = self._transform(net, transform_key)
+        # extract
+        extracted = self._extractor_cache.get(extractor_key)
+        if extracted is None:
+            extractor = self.extractors[extractor_key]
+            extract_kwargs = extract_kwargs_dict.get(extractor_key, {})
+            extracted = extractor(transformed, **extract_kwargs)
+            extracted_shape = extracted.shape
+            if extractor.flatten_ts:
+                if len(extracted_shape) == 3:
+                    extracted = extracted.view(extracted_shape[0], -1)
+            self._extractor_cache[extractor_key] = extracted
+        # execute
+        head_kwargs = head_kwargs_dict.get(key, {})
+        return self.heads[key](extracted, **head_kwargs)
+
     def clear_execute_cache(self) -> None:
         self._transform_cache = {}
         self._extractor_cache = {}
 
+    def predict_next(
+        self,
+        x_step: Tensor,
+        series_ids: Optional[Sequence[Hashable]] = None,
+        **kwargs: Any,
+    ) -> tensor_dict_type:
+        """
+        Streaming inference for time series tasks. `x_step` holds the processed
+        features of the next step of each series, with shape [B, D] or [B, S, D].
+        States are kept per series id (row position if `series_ids` is not
+        provided) and the least recently used ones are evicted beyond
+        `stream_capacity` series.
+        """
+        if not self.tr_data.is_ts:
+            raise ValueError("`predict_next` is only available for time series tasks")
+        if x_step.dim() == 2:
+            x_step = x_step.unsqueeze(1)
+        batch_size = x_step.shape[0]
+        if series_ids is None:
+            series_ids = list(range(batch_size))
+        if len(series_ids) != batch_size:
+            msg = f"{len(series_ids)} ids are provided for {batch_size} steps"
+            raise ValueError(msg)
+        if len(set(series_ids)) != batch_size:
+            raise ValueError("duplicate series ids are provided")
+        extractor_keys = set()
+        for key in self.pipes:
+            if key in self.bypassed_pipes:
+                continue
+            extractor_key = self.pipes[key][1]
+            if not self.extractors[extractor_key].supports_streaming:
+                msg = f"extractor '{extractor_key}' does not support streaming"
+                raise ValueError(msg)
+            extractor_keys.add(extractor_key)
+        # series whose states share the same shapes are batched together
+        groups: Dict[Any, List[int]] = {}
+        for i, series_id in enumerate(series_ids):
+            signature = _state_signature(self._stream_states.get(series_id))
+            groups.setdefault(signature, []).append(i)
+        group_results = []
+        for indices in groups.values():
+            states = [self._stream_states.get(series_ids[i]) for i in indices]
+            merged_states: Dict[str, Dict[str, Any]] = {}
+            for extractor_key in extractor_keys:
+                if states[0] is None:
+                    merged_states[extractor_key] = {}
+                else:
+                    pieces = [state[extractor_key] for state in states]  # type: ignore
+                    merged_states[extractor_key] = _merge_states(pieces)
+            extract_kwargs_dict = {
+                key: {"stream_state": state} for key, state in merged_states.items()
+            }
+            if len(groups) == 1:
+                group_step = x_step
+            else:
+                group_step = x_step[torch.tensor(indices, device=x_step.device)]
+            split = self._split_features(group_step, None, None)
+            outputs = self.execute(split, extract_kwargs_dict=extract_kwargs_dict)
+            group_results.append(self.aggregator.reduce(outputs, **kwargs))
+            # states are updated in place by the extractors
+            for j, i in enumerate(indices):
+                series_state = {
+                    key: _split_state(state, j) for key, state in merged_states.items()
+                }
+                self._stream_states[series_ids[i]] = series_state
+                self._stream_states.move_to_end(series_ids[i])
+        while len(self._stream_states) > self._stream_capacity:
+            self._stream_states.popitem(last=False)
+        if len(groups) == 1:
+            return group_results[0]
+        results: tensor_dict_type = {}
+        for indices, group_result in zip(groups.values(), group_results):
+            index_tensor = torch.tensor(indices, device=x_step.device)
+            for key, value in group_result.items():
+                if value is None:
+                    results[key] = None
+                    continue
+                result = results.get(key)
+                if result is None:
+                    result = value.new_empty(batch_size, *value.shape[1:])
+                    results[key] = result
+                result[index_tensor] = value
+        return results
+
+    def reset_stream(self) -> None:
+        self._stream_states = collections.OrderedDict()
+
     def get_split(self, processed: np.ndarray, device: torch.device) -> SplitFeatures:
         with torch.no_grad():
             return self._split_features(to_torch(processed).to(device), None, None)
@@ -506,6 +670,8 @@ class ModelBase(ModelProtocol, metaclass=ABCMeta):
     def export_context(self) -> context_error_handler:
         class _(context_error_handler):
             def __init__(self, model: ModelBase):
+                self.model = model
+                self.parallel_execute = model._parallel_execute
                 self.fast_dndf_settings: Dict[DNDF, bool] = {}
 
                 def _inject(node: Module) -> None:
@@ -518,15 +684,82 @@ class ModelBase(ModelProtocol, metaclass=ABCMeta):
                 _inject(model)
 
             def __enter__(self) -> None:
+                # tracing states are thread local
+                self.model._parallel_execute = False
                 for dndf in self.fast_dndf_settings:
                     dndf._fast = False
 
             def _normal_exit(self, exc_type: Any, exc_val: Any, exc_tb: Any) -> None:
+                self.model._parallel_execute = self.parallel_execute
                 for dndf, fast in self.fast_dndf_settings.items():
                     dndf._fast = fast
 
         return _(self)
 
+    def compile_for_inference(self, method: str = "trace", **kwargs: Any) -> Module:
+        """
+        Returns a module which maps `x_batch` to the (aggregated) outputs.
+
+        * 'trace' : traces the whole model with TorchScript, in eval mode. If it fails,
+        extractors & heads will be traced one by one, and those which cannot be traced
+        will stay eager. In this case the model will be switched to eval mode.
+        * 'compile' : wraps the model with `torch.compile`. The model will be switched
+        to eval mode.
+        """
+        wrapper = _InferenceWrapper(self)
+        if method == "compile":
+            if not hasattr(torch, "compile"):
+                raise ValueError("`torch.compile` is not available")
+            self.eval()
+            return torch.compile(wrapper, **kwargs)  # type: ignore
+        if method != "trace":
+            raise NotImplementedError(f"compile method '{method}' is not implemented")
+        x_batch = self.input_sample["x_batch"].to(self.device)
+        with eval_context(self), self.export_context():
+            try:
+                kwargs.setdefault("check_trace", False)
+                return torch.jit.trace(wrapper, x_batch, strict=False, **kwargs)
+            except Exception as err:
+                self.log_msg(
+                    f"failed to trace {type(self).__name__} ({err}), "
+                    "extractors & heads will be traced separately",
+                    prefix=self.warning_prefix,
+                    verbose_level=2,
+                    msg_level=logging.WARNING,
+                )
+            split = self._split_features(x_batch, None, None)
+            self.execute(split, clear_cache=False)
+            transformed = self._transform_cache
+            extracted = self._extractor_cache
+            self.clear_execute_cache()
+            extractors = {}
+            heads = {}
+            for key, (transform_key, extractor_key, _) in self.pipes.items():
+                if key in self.bypassed_pipes:
+                    continue
+                if extractor_key not in extractors:
+                    extractors[extractor_key] = self._try_trace(
+                        self.extractors[extractor_key],
+                        transformed[transform_key],
+                        extractor_key,
+                    )
+                head = self.heads[key]
+                heads[key] = self._try_trace(head, extracted[extractor_key], key)
+        self.eval()
+        return _PartiallyTraced(self, extractors, heads)
+
+    def _try_trace(self, module: Module, net: Tensor, name: str) -> Module:
+        try:
+            return torch.jit.trace(module, net, strict=False, check_trace=False)
+        except Exception as err:
+            self.log_msg(
+                f"failed to trace '{name}' ({err}), it will stay eager",
+                prefix=self.warning_prefix,
+                verbose_level=2,
+                msg_level=logging.WARNING,
+            )
+            return module
+
     def extra_repr(self) -> str:
         pipe_str = "\n".join(
             [f"  ({key}): {' -> '.join(pipe[1:])}" for key, pipe in self.pipes.items()]
@@ -585,4 +818,75 @@ class ModelBase(ModelProtocol, metaclass=ABCMeta):
         return _core
 
 
+def _state_signature(state: Any) -> Any:
+    if state is None:
+        return None
+    if isinstance(state, dict):
+        return tuple((k, _state_signature(v)) for k, v in sorted(state.items()))
+    if isinstance(state, (list, tuple)):
+        return tuple(map(_state_signature, state))
+    return tuple(state.shape[1:])
+
+
+def _merge_states(states: List[Any]) -> Any:
+    first = states[0]
+    if isinstance(first, dict):
+        return {k: _merge_states([state[k] for state in states]) for k in first}
+    if isinstance(first, (list, tuple)):
+        return [_merge_states(list(pieces)) for pieces in zip(*states)]
+    return torch.cat(states)
+
+
+def _split_state(state: Any, index: int) -> Any:
+    if isinstance(state, dict):
+        return {k: _split_state(v, index) for k, v in state.items()}
+    if isinstance(state, (list, tuple)):
+        return [_split_state(v, index) for v in state]
+    # cloned so that evicted series will not hold the merged tensors
+    return state[index : index + 1].clone()
+
+
+class _InferenceWrapper(Module):
+    def __init__(self, model: ModelBase):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x_batch: Tensor) -> tensor_dict_type:
+        return self.model({"x_batch": x_batch})
+
+
+class _PartiallyTraced(Module):
+    def __init__(
+        self,
+        model: ModelBase,
+        extractors: Dict[str, Module],
+        heads: Dict[str, Module],
+    ):
+        super().__init__()
+        self.model = model
+        self.extractors = ModuleDict(extractors)
+        self.heads = ModuleDict(heads)
+        self.flatten_ts = {
+            key: model.extractors[key].flatten_ts for key in extractors  # type: ignore
+        }
+
+    def forward(self, x_batch: Tensor) -> tensor_dict_type:
+        model = self.model
+        split = model._split_features(x_batch, None, None)
+        extracted_dict: Dict[str, Tensor] = {}
+        results: Dict[str, Tensor] = {}
+        for key, head in self.heads.items():
+            transform_key, extractor_key, _ = model.pipes[key]
+            transformed = model._transform(split, transform_key)
+            extracted = extracted_dict.get(extractor_key)
+            if extracted is None:
+                extracted = self.extractors[extractor_key](transformed)
+                if self.flatten_ts[extractor_key] and len(extracted.shape) == 3:
+                    extracted = extracted.view(extracted.shape[0], -1)
+                extracted_dict[extractor_key] = extracted
+            results[key] = head(extracted)
+        model.clear_execute_cache()
+        return model.aggregator.reduce(results)
+
+
 __all__ = ["ModelBase"]
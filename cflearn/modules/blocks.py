@@ -7,6 +7,7 @@ import torch.nn.functional as F
 
 from abc import abstractmethod
 from abc import ABCMeta
+from collections import OrderedDict
 from torch import Tensor
 from typing import Any
 from typing import Dict
@@ -430,10 +431,8 @@ class Route(torch.autograd.Function):
     def forward(ctx: Any, *args: Any, **kwargs: Any) -> Tensor:
         (
             net,
-            tree_arange,
-            batch_indices,
+            flat_indices,
             ones,
-            increment_masks,
             num_tree,
             num_batch,
             tree_depth,
@@ -445,15 +444,10 @@ class Route(torch.autograd.Function):
         p_right = 1.0 - p_left
         flat_probabilities = torch.cat([p_left, p_right], dim=-1)
         flat_probabilities = flat_probabilities.contiguous().view(num_tree, -1)
-        current_indices = batch_indices + increment_masks[0]
-        flat_dim = flat_probabilities.shape[-1]
-        tree_arange = tree_arange * flat_dim
-        routes = flat_probabilities.take(tree_arange + current_indices[None, ...])
+        routes = flat_probabilities.take(flat_indices[0])
         all_routes = [routes.clone()]
         for i in range(1, tree_depth + 1):
-            current_indices = batch_indices + increment_masks[i]
-            current_indices = tree_arange + current_indices[None, ...]
-            current_routes = flat_probabilities.take(current_indices)
+            current_routes = flat_probabilities.take(flat_indices[i])
             all_routes.append(current_routes)
             routes *= current_routes
         ctx.save_for_backward(ones, sigmoid_net, *all_routes)
@@ -464,7 +458,7 @@ class Route(torch.autograd.Function):
     @staticmethod
     def backward(ctx: Any, *grad_outputs: Any) -> Tuple[Optional[Tensor], ...]:
         grad_output = grad_outputs[0]
-        dummy_grads = tuple(None for _ in range(8))
+        dummy_grads = tuple(None for _ in range(6))
         if grad_output is None:
             return (None,) + dummy_grads
         num_tree = ctx.num_tree
@@ -495,7 +489,71 @@ class Route(torch.autograd.Function):
         return (sigmoid_net * (1.0 - sigmoid_net) * sub_grads,) + dummy_grads
 
 
+def _num_bytes(tensor: Tensor) -> int:
+    return tensor.numel() * tensor.element_size()
+
+
+def _split_routes(routes: Tensor, p_left: Tensor) -> Tensor:
+    left = routes * p_left
+    right = routes - left
+    return torch.stack([left, right], dim=-1).view(*routes.shape[:-1], -1)
+
+
+class LowMemoryRoute(torch.autograd.Function):
+    """
+    Computes the leaf probabilities level by level, and only the sigmoid outputs
+    are saved for backward. Intermediate routes are recomputed in backward.
+    """
+
+    @staticmethod
+    def forward(ctx: Any, *args: Any, **kwargs: Any) -> Tensor:
+        net, num_tree, tree_depth = args
+        sigmoid_net = torch.sigmoid(net)
+        ctx.save_for_backward(sigmoid_net)
+        ctx.num_tree = num_tree
+        ctx.tree_depth = tree_depth
+        p_left = LowMemoryRoute._p_left(sigmoid_net, num_tree)
+        routes = p_left.new_ones(*p_left.shape[:-1], 1)
+        for i in range(tree_depth + 1):
+            routes = _split_routes(routes, p_left[..., 2 ** i - 1 : 2 ** (i + 1) - 1])
+        return routes
+
+    @staticmethod
+    def backward(ctx: Any, *grad_outputs: Any) -> Tuple[Optional[Tensor], ...]:
+        grad_output = grad_outputs[0]
+        if grad_output is None:
+            return None, None, None
+        tree_depth = ctx.tree_depth
+        (sigmoid_net,) = ctx.saved_tensors
+        p_left = LowMemoryRoute._p_left(sigmoid_net, ctx.num_tree)
+        # routes to the internal nodes of each level
+        node_routes = [p_left.new_ones(*p_left.shape[:-1], 1)]
+        for i in range(tree_depth):
+            p_level = p_left[..., 2 ** i - 1 : 2 ** (i + 1) - 1]
+            node_routes.append(_split_routes(node_routes[-1], p_level))
+        # `sub_grad` holds the gradients w.r.t. the routes of the current level
+        p_grads = []
+        sub_grad = grad_output
+        for i in reversed(range(tree_depth + 1)):
+            p_level = p_left[..., 2 ** i - 1 : 2 ** (i + 1) - 1]
+            children = sub_grad.reshape(*p_level.shape, 2)
+            left, right = children[..., 0], children[..., 1]
+            diff = left - right
+            p_grads.append(node_routes[i] * diff)
+            sub_grad = right + p_level * diff
+        p_grad = torch.cat(p_grads[::-1], dim=-1)
+        net_grad = p_grad * p_left * (1.0 - p_left)
+        return net_grad.transpose(0, 1).reshape(sigmoid_net.shape), None, None
+
+    @staticmethod
+    def _p_left(sigmoid_net: Tensor, num_tree: int) -> Tensor:
+        return sigmoid_net.view(sigmoid_net.shape[0], num_tree, -1).transpose(0, 1)
+
+
 class DNDF(Module):
+    # an entry takes (tree_depth + 1) * num_tree * num_batch * num_leaf int64s
+    indices_cache_bytes = 32 * 2 ** 20
+
     def __init__(
         self,
         in_dim: int,
@@ -506,6 +564,9 @@ class DNDF(Module):
         is_regression: Optional[bool] = None,
         tree_proj_config: Optional[Dict[str, Any]] = None,
         use_fast_dndf: bool = True,
+        low_memory: bool = False,
+        sparse_top_k: Optional[int] = None,
+        sparse_threshold: Optional[float] = None,
     ):
         super().__init__()
         self._num_tree = num_tree
@@ -515,6 +576,9 @@ class DNDF(Module):
         self._num_internals = self._num_leaf - 1
         self._output_dim = out_dim
         self._fast = use_fast_dndf
+        self._low_memory = low_memory
+        self._indices_cache: Dict[Tuple[int, torch.device], Tensor] = OrderedDict()
+        self.set_sparse_inference(sparse_top_k, sparse_threshold)
         if tree_proj_config is None:
             tree_proj_config = {}
         tree_proj_config.setdefault("pruner_config", {})
@@ -553,18 +617,16 @@ class DNDF(Module):
     def forward(self, net: Tensor) -> Tensor:
         num_batch = net.shape[0]
         tree_net = self.tree_proj(net)
+        if self._use_sparse_inference:
+            return self._sparse_forward(tree_net) / self._num_tree
 
-        num_flat_prob = 2 * self._num_internals
-        arange_args = 0, num_flat_prob * num_batch, num_flat_prob
-        batch_indices = torch.arange(*arange_args, device=tree_net.device).view(-1, 1)
-
-        if self._fast:
+        if self._fast and self._low_memory:
+            routes = LowMemoryRoute.apply(tree_net, self._num_tree, self._tree_depth)
+        elif self._fast:
             routes = Route.apply(
                 tree_net,
-                self.tree_arange,
-                batch_indices,
+                self._get_flat_indices(num_batch, tree_net.device),
                 self.ones,
-                self.increment_indices,
                 self._num_tree,
                 num_batch,
                 self._tree_depth,
@@ -576,14 +638,10 @@ class DNDF(Module):
             p_right = 1.0 - p_left
             flat_probabilities = torch.cat([p_left, p_right], dim=-1).contiguous()
             flat_probabilities = flat_probabilities.view(self._num_tree, -1)
-            current_indices = batch_indices + self.increment_indices[0]  # type: ignore
-            flat_dim = flat_probabilities.shape[-1]
-            tree_arange = self.tree_arange * flat_dim  # type: ignore
-            routes = flat_probabilities.take(tree_arange + current_indices[None, ...])
+            flat_indices = self._get_flat_indices(num_batch, tree_net.device)
+            routes = flat_probabilities.take(flat_indices[0])
             for i in range(1, self._tree_depth + 1):
-                current_indices = batch_indices + self.increment_indices[i]  # type: ignore
-                current_indices = tree_arange + current_indices[None, ...]
-                routes *= flat_probabilities.take(current_indices)
+                routes *= flat_probabilities.take(flat_indices[i])
 
         features = routes.transpose(0, 1).contiguous().view(num_batch, -1)
         if self._is_regression or self._output_dim <= 1:
@@ -596,6 +654,92 @@ class DNDF(Module):
                 outputs = features.mm(leaves)
         return outputs / self._num_tree
 
+    def set_sparse_inference(
+        self,
+        top_k: Optional[int] = None,
+        threshold: Optional[float] = None,
+    ) -> "DNDF":
+        if top_k is not None and not 1 <= top_k <= self._num_leaf:
+            raise ValueError(f"`top_k` should be in [1, {self._num_leaf}]")
+        self._sparse_top_k = top_k
+        self._sparse_threshold = threshold
+        return self
+
+    @property
+    def _use_sparse_inference(self) -> bool:
+        if self.training or torch.jit.is_tracing():
+            return False
+        return self._sparse_top_k is not None or self._sparse_threshold is not None
+
+    def _pruned_route(self, tree_net: Tensor, top_k: int) -> Tuple[Tensor, Tensor]:
+        # carries only the `top_k` most probable paths of each tree down level by
+        # level, so the pruned sub-trees are never expanded. The route of a leaf is
+        # bounded by the routes of its ancestors, so this approximates the top-k
+        # leaves of the dense routes (and equals them when `top_k` >= num_leaf / 2)
+        num_batch = tree_net.shape[0]
+        p_left = torch.sigmoid(tree_net).view(num_batch, -1, self._num_internals)
+        p_left = p_left.transpose(0, 1)
+        shape = self._num_tree, num_batch, 1
+        positions = torch.zeros(*shape, dtype=torch.long, device=tree_net.device)
+        routes = torch.ones(*shape, dtype=p_left.dtype, device=tree_net.device)
+        for i in range(self._tree_depth + 1):
+            left_routes = routes * p_left.gather(2, positions + 2 ** i - 1)
+            routes = torch.cat([left_routes, routes - left_routes], dim=2)
+            positions = torch.cat([2 * positions, 2 * positions + 1], dim=2)
+            if routes.shape[-1] > top_k:
+                routes, kept = routes.topk(top_k, dim=-1)
+                positions = positions.gather(2, kept)
+        return routes, positions
+
+    def _sparse_forward(self, tree_net: Tensor) -> Tensor:
+        # only the kept leaves of each tree are aggregated, and their routing
+        # probabilities are renormalized to sum to 1 within each tree
+        top_k = self._sparse_top_k
+        if top_k is None:
+            top_k = self._num_leaf
+        routes, leaf_indices = self._pruned_route(tree_net, top_k)
+        if self._sparse_threshold is not None:
+            max_routes = routes.max(dim=-1, keepdim=True)[0]
+            threshold = max_routes.clamp(max=self._sparse_threshold)
+            routes = routes.masked_fill(routes < threshold, 0.0)
+        routes = routes / routes.sum(dim=-1, keepdim=True)
+        leaves: Tensor
+        if self._is_regression or self._output_dim <= 1:
+            leaves = self.leaves
+        else:
+            leaves = F.softmax(self.leaves, dim=1)
+        leaf_offsets = self.tree_arange * self._num_leaf  # type: ignore
+        selected_leaves = leaves[leaf_indices + leaf_offsets]
+        return torch.einsum("tbk,tbko->bo", routes, selected_leaves)
+
+    def _get_flat_indices(self, num_batch: int, device: torch.device) -> Tensor:
+        # [tree_depth + 1, num_tree, num_batch, num_leaf] indices into the
+        # flattened [num_tree, num_batch * 2 * num_internals] probabilities
+        tracing = torch.jit.is_tracing()
+        key = num_batch, device
+        if not tracing:
+            cached_indices = self._indices_cache.get(key)
+            if cached_indices is not None:
+                self._indices_cache.move_to_end(key)  # type: ignore
+                return cached_indices
+        num_flat_prob = 2 * self._num_internals
+        flat_dim = num_flat_prob * num_batch
+        batch_indices = torch.arange(0, flat_dim, num_flat_prob, device=device)
+        tree_offsets = self.tree_arange.to(device) * flat_dim  # type: ignore
+        increment_indices = self.increment_indices.to(device)  # type: ignore
+        flat_indices = (
+            tree_offsets[None, ...]
+            + batch_indices.view(1, 1, -1, 1)
+            + increment_indices[:, None, None, :]
+        )
+        if not tracing and _num_bytes(flat_indices) <= self.indices_cache_bytes:
+            self._indices_cache[key] = flat_indices
+            cached_bytes = sum(map(_num_bytes, self._indices_cache.values()))
+            while cached_bytes > self.indices_cache_bytes:
+                _, popped = self._indices_cache.popitem(last=False)  # type: ignore
+                cached_bytes -= _num_bytes(popped)
+        return flat_indices
+
 
 class CrossBase(Module, metaclass=ABCMeta):
     @abstractmethod
@@ -1065,9 +1209,12 @@ class ConditionalBlocks(Module):
         return f"{add_last}\n{detach_condition}"
 
 
+_has_fused_attention = hasattr(F, "scaled_dot_product_attention")
+
+
 class AttentionOutput(NamedTuple):
     output: Tensor
-    weights: Tensor
+    weights: Optional[Tensor]
 
 
 class Attention(Module):
@@ -1158,8 +1305,13 @@ class Attention(Module):
         k: Tensor,
         v: Tensor,
         mask: Optional[Tensor] = None,
+        *,
+        return_weights: bool = True,
+        kv_cache: Optional[Dict[str, Tensor]] = None,
     ) -> AttentionOutput:
         # `mask` represents slots which will be zeroed
+        # `kv_cache` holds the projected keys & values of previous calls, and the
+        # current ones will be appended to it in place
         k_len = k.shape[1]
         if self.is_self_attn:
             q, k, v = self.in_linear(q).chunk(3, dim=-1)
@@ -1171,32 +1323,74 @@ class Attention(Module):
             # B, Sv, Dv -> B, Sk, D
             v = self.v_linear(v)
         q, k, v = map(self.activation, [q, k, v])
-        # scale
-        q = q * self.scaling
-        # B, S*, D -> B * N_head, S*, D_head
-        q, k, v = map(self._to_heads, [q, k, v])
+        if kv_cache is not None:
+            if kv_cache:
+                # B, S_cache, D -> B, S_cache + Sk, D
+                k = torch.cat([kv_cache["k"], k], dim=1)
+                v = torch.cat([kv_cache["v"], v], dim=1)
+                k_len = k.shape[1]
+            kv_cache["k"], kv_cache["v"] = k, v
+        weights: Optional[Tensor]
+        if not return_weights and _has_fused_attention:
+            output = self._fused_attention(q, k, v, mask)
+            weights = None
+        else:
+            # scale
+            q = q * self.scaling
+            # B, S*, D -> B * N_head, S*, D_head
+            q, k, v = map(self._to_heads, [q, k, v])
+            if mask is not None:
+                # B, Sq, Sk -> B * N_head, Sq, Sk
+                mask = mask.repeat(self.num_heads, 1, 1)
+            # B * N_head, Sq, Sk
+            raw_weights = torch.bmm(q, k.transpose(-2, -1))
+            if mask is not None:
+                raw_weights.masked_fill_(mask, float("-inf"))
+            # B * N_head, Sq, Sk -> # B * N_head, Sq, Sk
+            weights = F.softmax(raw_weights, dim=-1)
+            if 0.0 < self.dropout < 1.0:
+                weights = F.dropout(weights, self.dropout, self.training)
+            # B * N_head, Sq, D_head
+            output = torch.bmm(weights, v)
+            # B * N_head, Sq, D_head -> B, N_head, Sq, D_head
+            nb, q_len, d_head = output.shape
+            output = output.view(nb // self.num_heads, self.num_heads, q_len, d_head)
+            # B, N_head, Sq, D_head -> B, Sq, D
+            output = output.permute(0, 2, 1, 3).contiguous()
+            output = output.view(-1, q_len, self.embed_dim)
+            weights = weights.view(-1, self.num_heads, q_len, k_len)
+        # B, Sq, D -> B, Sq, Din
+        output = self.activation(self.out_linear(output))
+        return AttentionOutput(output, weights)
+
+    def _fused_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        mask: Optional[Tensor],
+    ) -> Tensor:
+        batch_size, q_len, k_len = q.shape[0], q.shape[1], k.shape[1]
+        # B, S*, D -> B, N_head, S*, D_head
+        shape = batch_size, -1, self.num_heads, self.head_dim
+        q, k, v = [t.view(*shape).transpose(1, 2) for t in [q, k, v]]
+        attn_mask = None
         if mask is not None:
-            # B, Sq, Sk -> B * N_head, Sq, Sk
+            # follows the same B * N_head layout as the non-fused path, and
+            # `scaled_dot_product_attention` treats True as slots to attend
             mask = mask.repeat(self.num_heads, 1, 1)
-        # B * N_head, Sq, Sk
-        raw_weights = torch.bmm(q, k.transpose(-2, -1))
-        if mask is not None:
-            raw_weights.masked_fill_(mask, float("-inf"))
-        # B * N_head, Sq, Sk -> # B * N_head, Sq, Sk
-        weights = F.softmax(raw_weights, dim=-1)
-        if 0.0 < self.dropout < 1.0:
-            weights = F.dropout(weights, self.dropout, self.training)
-        # B * N_head, Sq, D_head
-        output = torch.bmm(weights, v)
-        # B * N_head, Sq, D_head -> B, N_head, Sq, D_head
-        nb, q_len, d_head = output.shape
-        output = output.view(nb // self.num_heads, self.num_heads, q_len, d_head)
+            attn_mask = ~mask.view(batch_size, self.num_heads, q_len, k_len)
+        dropout = self.dropout if self.training and 0.0 < self.dropout < 1.0 else 0.0
+        # B, N_head, Sq, D_head
+        output = F.scaled_dot_product_attention(
+            q,
+            k,
+            v,
+            attn_mask=attn_mask,
+            dropout_p=dropout,
+        )
         # B, N_head, Sq, D_head -> B, Sq, D
-        output = output.permute(0, 2, 1, 3).contiguous()
-        output = output.view(-1, q_len, self.embed_dim)
-        # B, Sq, D -> B, Sq, Din
-        output = self.activation(self.out_linear(output))
-        return AttentionOutput(output, weights.view(-1, self.num_heads, q_len, k_len))
+        return output.transpose(1, 2).reshape(batch_size, q_len, self.embed_dim)
 
 
 __all__ = [
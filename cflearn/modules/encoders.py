@@ -1,6 +1,7 @@
 import math
 import torch
 import logging
+import collections
 
 import numpy as np
 import torch.nn as nn
@@ -12,6 +13,7 @@ from cfdata.tabular.misc import np_int_type
 
 from ..protocol import DataLoaderProtocol
 from ..misc.toolkit import to_torch
+from ..misc.toolkit import to_column_slice
 from ..misc.toolkit import Lambda
 from ..misc.toolkit import Initializer
 from ..misc.toolkit import LoggingMixinWithRank
@@ -35,17 +37,6 @@ class EncodingResult(NamedTuple):
         return torch.cat([self.one_hot, self.embedding], dim=1)
 
 
-class OneHot(nn.Module):
-    def __init__(self, dim: int):
-        super().__init__()
-        one_hot_fn = lambda column: nn.functional.one_hot(column, dim)
-        self.core = Lambda(one_hot_fn, f"one_hot_{dim}")
-        self.dim = dim
-
-    def forward(self, tensor: torch.Tensor) -> torch.Tensor:
-        return self.core(tensor).to(torch.float32)
-
-
 class Embedding(nn.Module):
     def __init__(
         self,
@@ -53,6 +44,7 @@ class Embedding(nn.Module):
         out_dim: int,
         init_method: Optional[str],
         init_config: Dict[str, Any],
+        sparse: bool = False,
     ):
         super().__init__()
         weights = torch.empty(in_dim, out_dim)
@@ -61,15 +53,23 @@ class Embedding(nn.Module):
         else:
             Initializer(init_config).initialize(weights, init_method)
         self.weights = nn.Parameter(weights)
-        embedding_fn = lambda column: nn.functional.embedding(column, self.weights)
+        embedding_fn = lambda column: nn.functional.embedding(
+            column,
+            self.weights,
+            sparse=sparse,
+        )
         self.core = Lambda(embedding_fn, f"embedding: {in_dim} -> {out_dim}")
         self.in_dim, self.out_dim = in_dim, out_dim
+        self.sparse = sparse
 
     def forward(self, tensor: torch.Tensor) -> torch.Tensor:
         return self.core(tensor)
 
 
 class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
+    hash_prime = 2 ** 31 - 1
+    max_hash_buckets = 2 ** 14
+
     def __init__(
         self,
         config: Dict[str, Any],
@@ -94,18 +94,30 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
         dims_tensor = torch.tensor(input_dims, dtype=torch.float32)
         self.register_buffer("input_dims", dims_tensor)
         self.tgt_columns = np.array(sorted(categorical_columns), np_int_type)
+        self._tgt_slice = to_column_slice(self.tgt_columns)
         self.merged_dims: Dict[int, int] = defaultdict(int)
         self.embeddings = nn.ModuleList()
-        self.one_hot_encoders = nn.ModuleList()
         self._one_hot_indices: List[int] = []
         self._embed_indices: List[int] = []
         self._embed_dims: List[int] = []
+        self._hashed_configs: Dict[int, Tuple[int, int]] = {}
         for i, (in_dim, methods, config) in enumerate(
             zip(input_dims, methods_list, configs)
         ):
             if isinstance(methods, str):
                 methods = [methods]
             self._register(i, in_dim, methods, config)
+        if len(set(self._embed_indices)) != self.num_embedding:
+            raise ValueError("each column could only be embedded once in `Encoder`")
+        table_dims = list(input_dims)
+        for i, (num_buckets, _) in self._hashed_configs.items():
+            table_dims[i] = num_buckets
+        # fused one hot
+        if self.use_one_hot:
+            assert isinstance(self.input_dims, torch.Tensor)
+            one_hot_dims = self.input_dims[self._one_hot_indices].to(torch.long)
+            one_hot_dims_cumsum = one_hot_dims.cumsum(0) - one_hot_dims
+            self.register_buffer("one_hot_dims_cumsum", one_hot_dims_cumsum)
         # fast embedding
         if self.use_embedding and self._use_fast_embed:
             if isinstance(self._unified_embed_dim, int):
@@ -143,25 +155,45 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
             assert isinstance(self._fe_init_config, dict)
             self.embeddings.append(
                 Embedding(
-                    sum(input_dims),
+                    sum(table_dims),
                     unified_embed_dim,
                     self._fe_init_method,
                     self._fe_init_config,
+                    self._sparse_embed,
                 )
             )
-            assert isinstance(self.input_dims, torch.Tensor)
-            embed_dims_cumsum = self.input_dims[self._embed_indices].cumsum(0)[:-1]
+            table_dims_tensor = torch.tensor(table_dims, dtype=torch.float32)
+            embed_dims_cumsum = table_dims_tensor[self._embed_indices].cumsum(0)[:-1]
             self.register_buffer("embed_dims_cumsum", embed_dims_cumsum)
+        # hashed embedding
+        self._use_hashing = len(self._hashed_configs) > 0
+        self._num_lookups = self.num_embedding
+        self.register_buffer("oob_bounds", None)
+        if self._use_hashing:
+            self._init_hashing(table_dims)
         # embedding dropout
         self.embedding_dropout = None
         if self.use_embedding and 0.0 < self._embed_drop < 1.0:
             self.embedding_dropout = Dropout(self._embed_drop)
-        # compile
+        # caches
         self.one_hot_columns = self.tgt_columns[self._one_hot_indices]
         self.embedding_columns = self.tgt_columns[self._embed_indices]
         self._all_one_hot = len(self.one_hot_columns) == len(input_dims)
         self._all_embedding = len(self.embedding_columns) == len(input_dims)
-        self._compile(loaders)
+        self._one_hot_int_type = torch.int64
+        if self.use_one_hot:
+            max_one_hot_dim = max(input_dims[i] for i in self._one_hot_indices)
+            self._one_hot_int_type = self._compact_int_type(max_one_hot_dim - 1)
+        # caches are not a part of the `state_dict`. By default they are compiled
+        # lazily, so the first forward pass with each loader iterates over a copy of
+        # it. If `eager_cache` is True, they will be compiled here instead
+        self._loaders = loaders
+        self._caches: "collections.OrderedDict[str, Dict[str, torch.Tensor]]"
+        self._caches = collections.OrderedDict()
+        self._uncached: Set[str] = set()
+        if self._eager_cache:
+            for name in loaders:
+                self._get_cache(name, torch.device("cpu"))
 
     @property
     def num_one_hot(self) -> int:
@@ -171,6 +203,12 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
     def num_embedding(self) -> int:
         return len(self._embed_indices)
 
+    @property
+    def sparse_parameters(self) -> List[nn.Parameter]:
+        if not self._sparse_embed:
+            return []
+        return [embedding.weights for embedding in self.embeddings]
+
     @property
     def use_one_hot(self) -> bool:
         return self.num_one_hot > 0
@@ -185,20 +223,23 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
         batch_indices: Optional[np.ndarray],
         loader_name: Optional[str],
     ) -> EncodingResult:
-        keys = None
-        if loader_name is not None:
-            keys = self._get_cache_keys(loader_name)
-        categorical_columns = x_batch[..., self.tgt_columns]
-        if batch_indices is None or loader_name is None:
+        cache = None
+        if loader_name is not None and batch_indices is not None:
+            cache = self._get_cache(loader_name, x_batch.device)
+        use_cache = cache is not None
+        # categorical features are only needed when they are not cached
+        categorical_columns = None
+        if not use_cache:
+            categorical_columns = self._fetch_categorical(x_batch)
             self._oob_imputation(categorical_columns)
-        use_cache = keys is not None and batch_indices is not None
         # one hot
         if not self.use_one_hot:
             one_hot = None
         else:
             if use_cache:
-                one_hot = getattr(self, keys["one_hot"])[batch_indices]  # type: ignore
+                one_hot = self._one_hot(cache["one_hot"][batch_indices])  # type: ignore
             else:
+                assert categorical_columns is not None
                 one_hot_columns = categorical_columns
                 if not self._all_one_hot:
                     one_hot_columns = one_hot_columns[..., self._one_hot_indices]
@@ -207,15 +248,11 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
         if not self.use_embedding:
             embedding = None
         else:
-            if not use_cache:
-                indices = categorical_columns
+            if use_cache:
+                indices = cache["indices"][batch_indices]  # type: ignore
             else:
-                indices = getattr(self, keys["indices"])[batch_indices]  # type: ignore
-            if not self._all_embedding:
-                indices = indices[..., self._embed_indices]
-            if not use_cache and self._use_fast_embed:
-                indices[..., 1:] += self.embed_dims_cumsum
-                indices = indices.to(torch.long)
+                assert categorical_columns is not None
+                indices = self._embedding_indices(categorical_columns)
             embedding = self._embedding(indices)
             if self.embedding_dropout is not None:
                 embedding = self.embedding_dropout(embedding)
@@ -231,10 +268,15 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
             "default_embedding_init_config", {"mean": 0.0, "std": 0.02}
         )
         self._use_fast_embed = config.setdefault("use_fast_embedding", True)
+        self._sparse_embed = config.setdefault("sparse_embedding", False)
         # [ mean | median | max | int ]
         self._unified_embed_dim = config.setdefault("unified_embedding_dim", "max")
         self._fe_init_method = config.setdefault("fast_embedding_init_method", None)
         self._fe_init_config = config.setdefault("fast_embedding_init_config", None)
+        self._hash_seed = config.setdefault("hash_seed", 142857)
+        # in MB, least recently used loader caches will be evicted beyond this budget
+        self._cache_budget = config.setdefault("cache_memory_budget", 1024)
+        self._eager_cache = config.setdefault("eager_cache", False)
 
     def _register(
         self,
@@ -251,7 +293,6 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
             attr(i, in_dim, config)
 
     def _register_one_hot(self, i: int, in_dim: int, _: Dict[str, Any]) -> None:
-        self.one_hot_encoders.append(OneHot(in_dim))
         self._one_hot_indices.append(i)
         self.merged_dims[i] += in_dim
         self.one_hot_dim += in_dim
@@ -286,19 +327,99 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
             self.merged_dims[i] += out_dim
             self.embedding_dim += out_dim
             self.merged_dim += out_dim
-            self.embeddings.append(Embedding(in_dim, out_dim, init_method, init_config))
+            self.embeddings.append(
+                Embedding(
+                    in_dim,
+                    out_dim,
+                    init_method,
+                    init_config,
+                    self._sparse_embed,
+                )
+            )
 
-    def _oob_imputation(
+    def _register_hashed_embedding(
         self,
-        categorical_columns: torch.Tensor,
-        batch_indices: Optional[np.ndarray] = None,
-        loader_name: Optional[str] = None,
+        i: int,
+        in_dim: int,
+        config: Dict[str, Any],
     ) -> None:
-        if loader_name is None or batch_indices is None:
-            oob_mask = categorical_columns >= self.input_dims
-        else:
-            keys = self._get_cache_keys(loader_name)
-            oob_mask = getattr(self, keys["oob"])[batch_indices]
+        # hashing only shrinks the embedding table of high cardinality columns, it
+        # does not separate unseen categories: those are mapped by the cfdata
+        # converters before reaching the encoder, so they share their buckets.
+        # by default the table is halved (but bounded by `max_hash_buckets`), and
+        # each value looks up two buckets. `config` may be shared among columns, so
+        # it should not be modified here
+        num_buckets = config.get("num_buckets")
+        if num_buckets is None:
+            num_buckets = min(math.ceil(in_dim / 2), self.max_hash_buckets)
+            num_buckets = max(1, num_buckets)
+        num_hashes = config.get("num_hashes", 2)
+        self._hashed_configs[i] = num_buckets, num_hashes
+        self._register_embedding(i, num_buckets, config)
+
+    def _init_hashing(self, table_dims: List[int]) -> None:
+        # every embedding lookup is `((x * a + b) % prime) % buckets + offset`, where
+        # `a = 1, b = 0` for common embeddings, so they are left unchanged
+        generator = torch.Generator().manual_seed(self._hash_seed)
+        prime = self.hash_prime
+        lookup_sources = []
+        lookup_columns = []
+        multipliers, biases, buckets = [], [], []
+        for j, i in enumerate(self._embed_indices):
+            hashed_config = self._hashed_configs.get(i)
+            num_hashes = 1 if hashed_config is None else hashed_config[1]
+            lookup_sources.extend([i] * num_hashes)
+            lookup_columns.extend([j] * num_hashes)
+            buckets.extend([table_dims[i]] * num_hashes)
+            if hashed_config is None:
+                multipliers.append(1)
+                biases.append(0)
+            else:
+                multipliers.extend(
+                    torch.randint(1, prime, [num_hashes], generator=generator).tolist()
+                )
+                biases.extend(
+                    torch.randint(0, prime, [num_hashes], generator=generator).tolist()
+                )
+        self._num_lookups = len(lookup_sources)
+        self._lookup_sources = np.array(lookup_sources, np_int_type)
+        lookup_columns_tensor = torch.tensor(lookup_columns, dtype=torch.long)
+        self.register_buffer("lookup_columns", lookup_columns_tensor)
+        self.register_buffer("hash_multipliers", torch.tensor(multipliers))
+        self.register_buffer("hash_biases", torch.tensor(biases))
+        self.register_buffer("hash_buckets", torch.tensor(buckets))
+        lookup_offsets = torch.zeros(self._num_lookups, dtype=torch.long)
+        if self._use_fast_embed:
+            cumsum = self.embed_dims_cumsum.to(torch.long)  # type: ignore
+            column_offsets = torch.cat([cumsum.new_zeros(1), cumsum])
+            lookup_offsets = column_offsets[lookup_columns_tensor]
+        self.register_buffer("lookup_offsets", lookup_offsets)
+        self._lookup_slices: List[Tuple[int, int]] = []
+        start = 0
+        for j in range(self.num_embedding):
+            end = start + lookup_columns.count(j)
+            self._lookup_slices.append((start, end))
+            start = end
+        # hashed columns accept any value, so they should not be imputed
+        oob_bounds = self.input_dims.clone()  # type: ignore
+        for i in self._hashed_configs:
+            if i not in self._one_hot_indices:
+                oob_bounds[i] = math.inf
+        self.oob_bounds = oob_bounds
+
+    def _fetch_categorical(self, x_batch: torch.Tensor) -> torch.Tensor:
+        # a copy is always returned because categorical features are modified inplace
+        if self._tgt_slice is None:
+            return x_batch[..., self.tgt_columns]
+        return x_batch[..., self._tgt_slice].clone()
+
+    def _oob_imputation(self, categorical_columns: torch.Tensor) -> None:
+        oob_bounds = self.input_dims if self.oob_bounds is None else self.oob_bounds
+        oob_mask = categorical_columns >= oob_bounds
+        # data dependent branches will be frozen when tracing, so always impute
+        if torch.jit.is_tracing():
+            categorical_columns.masked_fill_(oob_mask, 0.0)
+            return
         if torch.any(oob_mask):
             self.log_msg(  # type: ignore
                 "out of bound occurred, "
@@ -316,17 +437,27 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
         return list(columns.to(torch.long).t().unbind())
 
     def _one_hot(self, one_hot_columns: torch.Tensor) -> torch.Tensor:
-        split = self._to_split(one_hot_columns)
-        encodings = [
-            encoder(flat_feature)
-            for encoder, flat_feature in zip(self.one_hot_encoders, split)
-        ]
-        return torch.cat(encodings, dim=1)
+        # offset each column by the cumulative dims and scatter them all at once
+        indices = one_hot_columns.to(torch.long) + self.one_hot_dims_cumsum
+        # sized by `indices` instead of `len`, so traced modules keep the batch dim
+        one_hot = torch.zeros_like(indices[..., :1], dtype=torch.float32)
+        one_hot = one_hot.repeat(1, self.one_hot_dim)
+        return one_hot.scatter_(1, indices, 1.0)
 
     def _embedding(self, indices_columns: torch.Tensor) -> torch.Tensor:
         if self._use_fast_embed:
             embed_mat = self.embeddings[0](indices_columns)
+            # multiple hashes of the same column are summed up
+            if self._num_lookups > self.num_embedding:
+                summed = torch.zeros_like(embed_mat[:, : self.num_embedding])
+                embed_mat = summed.index_add_(1, self.lookup_columns, embed_mat)
             return embed_mat.view(-1, self.embedding_dim)
+        if self._use_hashing:
+            encodings = [
+                embedding(indices_columns[..., start:end]).sum(1)
+                for embedding, (start, end) in zip(self.embeddings, self._lookup_slices)
+            ]
+            return torch.cat(encodings, dim=1)
         split = self._to_split(indices_columns)
         encodings = [
             embedding(flat_feature)
@@ -334,43 +465,100 @@ class Encoder(nn.Module, LoggingMixinWithRank, metaclass=ABCMeta):
         ]
         return torch.cat(encodings, dim=1)
 
+    def _embedding_indices(self, categorical_columns: torch.Tensor) -> torch.Tensor:
+        if self._use_hashing:
+            columns = categorical_columns[..., self._lookup_sources].to(torch.long)
+            hashed = columns * self.hash_multipliers + self.hash_biases
+            return hashed % self.hash_prime % self.hash_buckets + self.lookup_offsets
+        indices = categorical_columns
+        if not self._all_embedding:
+            indices = indices[..., self._embed_indices]
+        if self._use_fast_embed:
+            indices[..., 1:] += self.embed_dims_cumsum
+        return indices.to(torch.long)
+
     @staticmethod
-    def _get_cache_keys(name: str) -> Dict[str, str]:
-        return {
-            "one_hot": f"{name}_one_hot_cache",
-            "indices": f"{name}_indices_cache",
-            "oob": f"{name}_oob_cache",
-        }
-
-    def _compile(self, loaders: Dict[str, DataLoaderProtocol]) -> None:
-        for name, loader in loaders.items():
-            categorical_features = []
-            return_indices = loader.return_indices
-            for sample in loader:
-                if return_indices:
-                    assert isinstance(sample, tuple)
-                    sample = sample[0]
-                assert isinstance(sample, dict)
-                x_batch = sample["x_batch"]
-                categorical_features.append(x_batch[..., self.tgt_columns])
-            tensor = to_torch(np.vstack(categorical_features))
-            keys = self._get_cache_keys(name)
-            # compile oob
-            self.register_buffer(keys["oob"], tensor >= self.input_dims)
-            self._oob_imputation(
-                tensor,
-                batch_indices=np.arange(len(tensor)),
-                loader_name=name,
-            )
-            # compile one hot
+    def _compact_int_type(max_value: int) -> torch.dtype:
+        for dtype in [torch.int8, torch.int16, torch.int32]:
+            if max_value <= torch.iinfo(dtype).max:
+                return dtype
+        return torch.int64
+
+    @property
+    def cache_nbytes(self) -> int:
+        return sum(
+            tensor.element_size() * tensor.numel()
+            for cache in self._caches.values()
+            for tensor in cache.values()
+        )
+
+    def clear_caches(self) -> None:
+        self._caches.clear()
+        self._uncached.clear()
+
+    def _get_cache(
+        self,
+        name: str,
+        device: torch.device,
+    ) -> Optional[Dict[str, torch.Tensor]]:
+        if name in self._uncached:
+            return None
+        cache = self._caches.get(name)
+        if cache is None:
+            loader = self._loaders.get(name)
+            if loader is None:
+                return None
+            row_nbytes = 0
             if self.use_one_hot:
-                one_hot_cache = self._one_hot(tensor[..., self._one_hot_indices])
-                self.register_buffer(keys["one_hot"], one_hot_cache)
-            # compile embedding
-            if self.use_embedding and self._use_fast_embed:
-                tensor[..., 1:] += self.embed_dims_cumsum
-                indices = tensor.to(torch.long)
-                self.register_buffer(keys["indices"], indices)
+                int_info = torch.iinfo(self._one_hot_int_type)
+                row_nbytes += self.num_one_hot * int_info.bits // 8
+            if self.use_embedding:
+                row_nbytes += self._num_lookups * 8
+            nbytes = loader.num_samples * row_nbytes
+            budget = self._cache_budget * 1024 ** 2
+            if nbytes > budget:
+                self.log_msg(  # type: ignore
+                    f"cache of '{name}' loader ({nbytes / 1024 ** 2:.2f}MB) exceeds "
+                    f"the budget ({self._cache_budget}MB), it will not be cached",
+                    prefix=self.warning_prefix,  # type: ignore
+                    verbose_level=4,
+                    msg_level=logging.WARNING,
+                )
+                self._uncached.add(name)
+                return None
+            while self._caches and self.cache_nbytes + nbytes > budget:
+                self._caches.popitem(last=False)
+            with torch.no_grad():
+                cache = self._compile(loader)
+            self._caches[name] = cache
+        self._caches.move_to_end(name)
+        for key, tensor in cache.items():
+            if tensor.device != device:
+                cache[key] = tensor.to(device)
+        return cache
+
+    def _compile(self, loader: DataLoaderProtocol) -> Dict[str, torch.Tensor]:
+        categorical_features = []
+        # loaders are stateful, so a copy is iterated in case `loader` is in use
+        loader = loader.copy()
+        return_indices = loader.return_indices
+        for sample in loader:
+            if return_indices:
+                assert isinstance(sample, tuple)
+                sample = sample[0]
+            assert isinstance(sample, dict)
+            x_batch = sample["x_batch"]
+            categorical_features.append(self._fetch_categorical(x_batch))
+        tensor = to_torch(np.vstack(categorical_features))
+        self._oob_imputation(tensor)
+        cache = {}
+        # only the indices are cached, one hot encodings are materialized per batch
+        if self.use_one_hot:
+            one_hot_columns = tensor[..., self._one_hot_indices]
+            cache["one_hot"] = one_hot_columns.to(self._one_hot_int_type)
+        if self.use_embedding:
+            cache["indices"] = self._embedding_indices(tensor)
+        return cache
 
 
 __all__ = ["Encoder", "EncodingResult"]
@@ -30,6 +30,12 @@ class ExtractorBase(nn.Module, metaclass=ABCMeta):
     def flatten_ts(self) -> bool:
         return True
 
+    @property
+    def supports_streaming(self) -> bool:
+        # streaming extractors accept a `stream_state` dict in `forward`, which
+        # carries their states across the steps of each series
+        return False
+
     @property
     @abstractmethod
     def out_dim(self) -> int:
@@ -2,6 +2,7 @@ import torch
 
 from typing import Any
 from typing import Dict
+from typing import Optional
 
 from ..base import ExtractorBase
 from ...transform.core import Dimensions
@@ -38,10 +39,42 @@ class RNN(ExtractorBase):
     def out_dim(self) -> int:
         return self.hidden_size
 
-    def forward(self, net: torch.Tensor) -> torch.Tensor:
-        for rnn in self.rnn_list:
-            net, final_state = rnn(net, None)
+    @property
+    def supports_streaming(self) -> bool:
+        return True
+
+    def forward(
+        self,
+        net: torch.Tensor,
+        stream_state: Optional[Dict[str, Any]] = None,
+    ) -> torch.Tensor:
+        if stream_state is None:
+            for rnn in self.rnn_list:
+                net, final_state = rnn(net, None)
+            return net[..., -1, :]
+        # hidden states are carried across calls, so each new step costs one
+        # cell step instead of a whole `num_history` long recurrence
+        states = stream_state.get("hidden")
+        new_states = []
+        for i, rnn in enumerate(self.rnn_list):
+            state = None if states is None else _to_rnn_state(states[i])
+            net, final_state = rnn(net, state)
+            new_states.append(_to_batch_first(final_state))
+        stream_state["hidden"] = new_states
         return net[..., -1, :]
 
 
+# states are kept batch first so they could be split & merged per series
+def _to_batch_first(state: Any) -> Any:
+    if isinstance(state, tuple):
+        return [s.transpose(0, 1) for s in state]
+    return state.transpose(0, 1)
+
+
+def _to_rnn_state(state: Any) -> Any:
+    if isinstance(state, list):
+        return tuple(s.transpose(0, 1).contiguous() for s in state)
+    return state.transpose(0, 1).contiguous()
+
+
 __all__ = ["RNN"]
@@ -46,8 +46,20 @@ class TransformerLayer(nn.Module):
         self.dropout2 = Dropout(dropout)
         self.activation = Activations.make(activation, activation_config)
 
-    def forward(self, net: torch.Tensor, mask: torch.Tensor = None) -> torch.Tensor:
-        new = self.self_attn(net, net, net, mask=mask).output
+    def forward(
+        self,
+        net: torch.Tensor,
+        mask: torch.Tensor = None,
+        kv_cache: Optional[Dict[str, torch.Tensor]] = None,
+    ) -> torch.Tensor:
+        new = self.self_attn(
+            net,
+            net,
+            net,
+            mask=mask,
+            return_weights=False,
+            kv_cache=kv_cache,
+        ).output
         net = net + self.dropout1(new)
         net = self.norm1(net)
         new = self.from_latent(self.dropout(self.activation(self.to_latent(net))))
@@ -94,11 +106,38 @@ class Transformer(ExtractorBase):
     def out_dim(self) -> int:
         return self.latent_dim
 
-    def forward(self, net: torch.Tensor) -> torch.Tensor:
+    @property
+    def supports_streaming(self) -> bool:
+        # cached steps are not refreshed by the later ones, which is only exact
+        # when there is a single layer
+        return len(self.layers) == 1
+
+    def forward(
+        self,
+        net: torch.Tensor,
+        stream_state: Optional[Dict[str, Any]] = None,
+    ) -> torch.Tensor:
         if self.input_linear is not None:
             net = self.input_linear(net)
-        for layer in self.layers:
-            net = layer(net, mask=None)
+        if stream_state is None:
+            for layer in self.layers:
+                net = layer(net, mask=None)
+        else:
+            if not self.supports_streaming:
+                raise ValueError(
+                    "streaming is only supported when `num_layers` is 1, "
+                    f"but {len(self.layers)} layers are used"
+                )
+            # keys & values are cached, so only the new steps are processed
+            kv_caches = stream_state.setdefault("kv_caches", [{} for _ in self.layers])
+            for layer, kv_cache in zip(self.layers, kv_caches):
+                net = layer(net, mask=None, kv_cache=kv_cache)
+            # the oldest steps are dropped so that the next step sees `num_history`
+            num_cached = self.dimensions.num_history - 1
+            for kv_cache in kv_caches:
+                for key, cached in kv_cache.items():
+                    start = max(0, cached.shape[1] - num_cached)
+                    kv_cache[key] = cached[:, start:]
         if self.norm is not None:
             net = self.norm(net)
         return net[..., -1, :]
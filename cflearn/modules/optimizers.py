@@ -19,6 +19,7 @@ register_optimizer("sgd")(torch.optim.SGD)
 register_optimizer("adam")(torch.optim.Adam)
 register_optimizer("adamw")(torch.optim.AdamW)
 register_optimizer("rmsprop")(torch.optim.RMSprop)
+register_optimizer("sparse_adam")(torch.optim.SparseAdam)
 
 
 @register_optimizer("nag")
@@ -4,6 +4,7 @@ import numpy as np
 
 from torch import Tensor
 from typing import Dict
+from typing import List
 from typing import Optional
 from typing import NamedTuple
 from torch.nn import Module
@@ -11,12 +12,15 @@ from cftool.misc import timing_context
 
 from ..encoders import Encoder
 from ..encoders import EncodingResult
+from ...misc.toolkit import to_column_slice
 from ...misc.toolkit import LoggingMixinWithRank
 
 
 class SplitFeatures(NamedTuple):
     categorical: Optional[EncodingResult]
     numerical: Optional[Tensor]
+    # holds the [ numerical | one_hot | embedding ] features, merged at most once
+    merged_cache: Optional[Dict[str, Tensor]] = None
 
     def merge(
         self,
@@ -24,8 +28,6 @@ class SplitFeatures(NamedTuple):
         use_embedding: bool = True,
         only_categorical: bool = False,
     ) -> Tensor:
-        if use_embedding and use_one_hot:
-            return self._merge_all(only_categorical)
         numerical = None if only_categorical else self.numerical
         if not use_embedding and not use_one_hot:
             if only_categorical:
@@ -41,29 +43,43 @@ class SplitFeatures(NamedTuple):
                 raise ValueError("categorical is not available")
             assert numerical is not None
             return numerical
-        if not use_one_hot:
-            embedding = categorical.embedding
-            assert embedding is not None
-            if numerical is None:
-                return embedding
-            return torch.cat([numerical, embedding], dim=1)
-        one_hot = categorical.one_hot
-        assert not use_embedding and one_hot is not None
-        if numerical is None:
-            return one_hot
-        return torch.cat([numerical, one_hot], dim=1)
-
-    def _merge_all(self, only_categorical: bool) -> Tensor:
+        if use_embedding and use_one_hot:
+            if categorical.one_hot is None and categorical.embedding is None:
+                raise ValueError("no data is provided in `EncodingResult`")
+        elif not use_one_hot:
+            assert categorical.embedding is not None
+        else:
+            assert categorical.one_hot is not None
+        one_hot = categorical.one_hot if use_one_hot else None
+        embedding = categorical.embedding if use_embedding else None
+        return self._merge([numerical, one_hot, embedding])
+
+    def _merge(self, pieces: List[Optional[Tensor]]) -> Tensor:
+        tensors = [piece for piece in pieces if piece is not None]
+        if len(tensors) == 1:
+            return tensors[0]
+        if self.merged_cache is None:
+            return torch.cat(tensors, dim=1)
         categorical = self.categorical
-        if categorical is None:
-            if only_categorical:
-                raise ValueError("categorical is not available")
-            assert self.numerical is not None
-            return self.numerical
-        merged = categorical.merged
-        if only_categorical or self.numerical is None:
+        assert categorical is not None
+        all_pieces = [self.numerical, categorical.one_hot, categorical.embedding]
+        existing = [piece for piece in all_pieces if piece is not None]
+        # adjacent pieces could be sliced from the merged features as a view
+        positions = [
+            i
+            for i, piece in enumerate(existing)
+            if any(piece is tensor for tensor in tensors)
+        ]
+        if positions[-1] - positions[0] != len(positions) - 1:
+            return torch.cat(tensors, dim=1)
+        merged = self.merged_cache.get("merged")
+        if merged is None:
+            merged = self.merged_cache["merged"] = torch.cat(existing, dim=1)
+        start = sum(piece.shape[1] for piece in existing[: positions[0]])
+        end = start + sum(tensor.shape[1] for tensor in tensors)
+        if start == 0 and end == merged.shape[1]:
             return merged
-        return torch.cat([self.numerical, merged], dim=1)
+        return merged[:, start:end]
 
 
 class Dimensions(LoggingMixinWithRank):
@@ -79,6 +95,8 @@ class Dimensions(LoggingMixinWithRank):
         self.numerical_columns_mapping = numerical_columns_mapping
         self.categorical_columns_mapping = categorical_columns_mapping
         self._numerical_columns = sorted(numerical_columns_mapping.values())
+        # numerical features could be fetched as a view if they are contiguous
+        self._numerical_slice = to_column_slice(self._numerical_columns)
         self.num_history = num_history
 
     @property
@@ -128,9 +146,11 @@ class Dimensions(LoggingMixinWithRank):
             numerical_columns = self._numerical_columns
             if not numerical_columns:
                 numerical = None
+            elif self._numerical_slice is not None:
+                numerical = x_batch[..., self._numerical_slice]
             else:
                 numerical = x_batch[..., numerical_columns]
-        return SplitFeatures(encoding_result, numerical)
+        return SplitFeatures(encoding_result, numerical, {})
 
 
 class Transform(Module):
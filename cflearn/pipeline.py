@@ -631,6 +631,7 @@ class Pipeline(LoggingMixinWithRank):
             self.cv_batch_size,
             is_onnx=self.inference.onnx is not None,
             contains_labels=contains_labels,
+            cpu_prefetch_depth=self.cpu_prefetch_depth or 0,
         )
         kwargs = shallow_copy_dict(kwargs)
         kwargs.update(
@@ -645,6 +646,58 @@ class Pipeline(LoggingMixinWithRank):
             raise ValueError("`inference` is not yet generated")
         return self.inference.predict(loader, **shallow_copy_dict(kwargs))
 
+    def predict_array(
+        self,
+        x: np.ndarray,
+        *,
+        return_all: bool = False,
+        requires_recover: bool = True,
+        returns_probabilities: bool = False,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, Dict[str, np.ndarray]]:
+        if self.inference is None:
+            raise ValueError("`inference` is not yet generated")
+        return self.inference.predict_array(
+            x,
+            self.device,
+            return_all=return_all,
+            requires_recover=requires_recover,
+            returns_probabilities=returns_probabilities,
+            **shallow_copy_dict(kwargs),
+        )
+
+    def predict_next(
+        self,
+        x: np.ndarray,
+        series_ids: Optional[Sequence[Hashable]] = None,
+        *,
+        return_all: bool = False,
+        requires_recover: bool = True,
+        returns_probabilities: bool = False,
+        **kwargs: Any,
+    ) -> Union[np.ndarray, Dict[str, np.ndarray]]:
+        """
+        Rolling forecasts for time series tasks. Each row of `x` should be the next
+        (raw) step of the series with the corresponding id in `series_ids`, which
+        defaults to the row position. `reset_stream` clears all states.
+        """
+        if self.inference is None:
+            raise ValueError("`inference` is not yet generated")
+        return self.inference.predict_next(
+            x,
+            self.device,
+            series_ids,
+            return_all=return_all,
+            requires_recover=requires_recover,
+            returns_probabilities=returns_probabilities,
+            **shallow_copy_dict(kwargs),
+        )
+
+    def reset_stream(self) -> None:
+        if self.inference is None:
+            raise ValueError("`inference` is not yet generated")
+        self.inference.reset_stream()
+
     def predict_prob(
         self,
         x: data_type,
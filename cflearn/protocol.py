@@ -2,8 +2,10 @@ import os
 import json
 import math
 import torch
+import queue
 import pprint
 import logging
+import threading
 
 import numpy as np
 import torch.nn as nn
@@ -34,6 +36,8 @@ from cfdata.tabular import str_data_type
 from cfdata.tabular import TaskTypes
 from cfdata.tabular import DataTuple
 from cfdata.tabular.recognizer import Recognizer
+from cfdata.tabular.converters import Converter
+from cfdata.tabular.processors import Processor
 
 from .types import np_dict_type
 from .types import tensor_dict_type
@@ -70,7 +74,10 @@ class DataProtocol(ABC):
     converted: DataTuple
     processed: DataTuple
     ts_indices: Set[int]
+    excludes: Set[int]
     recognizers: Dict[int, Optional[Recognizer]]
+    converters: Dict[int, Optional[Converter]]
+    processors: Dict[int, Optional[Processor]]
 
     _verbose_level: int
     _has_column_names: bool
@@ -294,6 +301,7 @@ class PrefetchLoader:
         *,
         is_onnx: bool = False,
         enable_prefetch: bool = False,
+        cpu_prefetch_depth: int = 0,
     ):
         self.loader = loader
         self.device = device
@@ -308,13 +316,21 @@ class PrefetchLoader:
         self.stop_at_next_batch = False
         self.batch_size = loader.batch_size
         self._num_siamese = loader._num_siamese
+        # cpu prefetch
+        self.cpu_prefetch_depth = cpu_prefetch_depth
+        self._queue: Optional[queue.Queue] = None
+        self._worker: Optional[threading.Thread] = None
+        self._stop_event: Optional[threading.Event] = None
 
     def __len__(self) -> int:
         return len(self.loader)
 
     def __iter__(self) -> "PrefetchLoader":
         self.stop_at_next_batch = False
+        self.close()
         self.loader.__iter__()
+        if self.use_cpu_prefetch:
+            self._start_worker()
         self.preload()
         return self
 
@@ -342,18 +358,63 @@ class PrefetchLoader:
             indices_tensor = indices_tensor.to(self.device, **kwargs)  # type: ignore
             self.next_batch_indices = indices_tensor
 
-    def preload(self) -> None:
+    def _fetch(self) -> Optional[Tuple[Any, Optional[torch.Tensor]]]:
         try:
             sample = self.loader.__next__()
         except StopIteration:
-            self.stop_at_next_batch = True
             return None
-        indices_tensor: Optional[torch.Tensor]
         if not self.return_indices:
-            indices_tensor = None
+            return sample, None
+        sample, batch_indices = sample  # type: ignore
+        return sample, to_torch(batch_indices).to(torch.long)
+
+    def _start_worker(self) -> None:
+        self._queue = queue.Queue(maxsize=self.cpu_prefetch_depth)
+        self._stop_event = threading.Event()
+        self._worker = threading.Thread(
+            target=self._produce,
+            args=(self._queue, self._stop_event),
+            daemon=True,
+        )
+        self._worker.start()
+
+    def _produce(self, q: queue.Queue, stop_event: threading.Event) -> None:
+        while not stop_event.is_set():
+            try:
+                item: Any = self._fetch()
+            except Exception as err:
+                item = err
+            while not stop_event.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            if item is None or isinstance(item, Exception):
+                return None
+
+    def close(self) -> None:
+        if self._worker is None:
+            return None
+        assert self._stop_event is not None
+        self._stop_event.set()
+        self._worker.join()
+        self._queue = self._worker = self._stop_event = None
+
+    def preload(self) -> None:
+        if self._queue is None:
+            item = self._fetch()
         else:
-            sample, batch_indices = sample  # type: ignore
-            indices_tensor = to_torch(batch_indices).to(torch.long)
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                self.stop_at_next_batch = True
+                self.close()
+                raise item
+        if item is None:
+            self.stop_at_next_batch = True
+            self.close()
+            return None
+        sample, indices_tensor = item
 
         self.next_batch = sample  # type: ignore
         if self.is_cpu:
@@ -378,6 +439,10 @@ class PrefetchLoader:
     def use_stream(self) -> bool:
         return self.enable_prefetch and not self.is_cpu
 
+    @property
+    def use_cpu_prefetch(self) -> bool:
+        return self.cpu_prefetch_depth > 0
+
 
 class TrainerState:
     def __init__(self, trainer_config: Dict[str, Any]):
@@ -750,6 +815,7 @@ class InferenceProtocol(ABC):
         **kwargs: Any,
     ) -> InferenceOutputs:
         labels_key = loader.loader.labels_key
+        prefetch_loader = loader
         if use_tqdm:
             loader = self.to_tqdm(loader)
 
@@ -808,6 +874,7 @@ class InferenceProtocol(ABC):
                 if local_losses is not None:
                     for k, v in local_losses.items():
                         loss_items.setdefault(k, []).append(v.item())
+            prefetch_loader.close()
 
             if return_outputs:
                 results = {k: np.vstack(v) for k, v in results.items()}
@@ -6,12 +6,15 @@ import mlflow
 import optuna
 import getpass
 import logging
+import threading
 
 import numpy as np
 
 from typing import *
 from abc import abstractmethod
 from abc import ABC
+from collections import deque
+from functools import partial
 from tqdm.autonotebook import tqdm
 from torch.optim import Optimizer
 from torch.optim.lr_scheduler import _LRScheduler
@@ -53,6 +56,62 @@ from .protocol import DataLoaderProtocol
 from .modules.schedulers import WarmupScheduler
 
 
+def _atomic_write(path: str, write_fn: Callable[[str], None]) -> None:
+    # readers will either see the old file or the complete new file
+    tmp_path = f"{path}.tmp"
+    write_fn(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class _CheckpointWriter:
+    """
+    Runs checkpoint writing tasks in a background thread, one at a time and in
+    order. At most `max_pending` tasks are queued, older pending tasks (which are
+    stale snapshots) will be dropped when new ones come in.
+    """
+
+    def __init__(self, max_pending: int = 1):
+        self.max_pending = max(1, max_pending)
+        self._condition = threading.Condition()
+        self._pending: Deque[Callable[[], None]] = deque()
+        self._writing = False
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def submit(self, task: Callable[[], None]) -> None:
+        with self._condition:
+            while len(self._pending) >= self.max_pending:
+                self._pending.popleft()
+            self._pending.append(task)
+            self._condition.notify_all()
+
+    def wait(self) -> None:
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+            error, self._error = self._error, None
+        if error is not None:
+            raise error
+
+    def _loop(self) -> None:
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                task = self._pending.popleft()
+                self._writing = True
+            try:
+                task()
+            except BaseException as err:
+                with self._condition:
+                    self._error = err
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+
 class IntermediateResults(NamedTuple):
     metrics: Dict[str, float]
     weighted_metrics: Dict[str, float]
@@ -391,6 +450,7 @@ class TqdmSettings(NamedTuple):
 
 class Trainer(MonitoredMixin):
     callback_base = TrainerCallback
+    sparse_optimizer_key = "sparse_embeddings"
 
     def __init__(
         self,
@@ -431,6 +491,11 @@ class Trainer(MonitoredMixin):
         self.update_bt_runtime = self.update_binary_threshold_at_runtime
         self.grad_scaler = None if amp is None or not self.use_amp else amp.GradScaler()
         self.state = TrainerState(self.config)
+        # checkpoints saved during training could be written in the background
+        self._checkpoint_writer: Optional[_CheckpointWriter] = None
+        if self.config.setdefault("async_checkpoint", False):
+            max_pending = self.config.setdefault("max_pending_checkpoints", 1)
+            self._checkpoint_writer = _CheckpointWriter(max_pending)
 
     def __getattr__(self, item: str) -> Any:
         value = self.config.get(item)
@@ -638,24 +703,61 @@ class Trainer(MonitoredMixin):
             "plateau": plateau_default_cfg,
         }
 
+    def _group_parameters(self, params_name: str) -> List[torch.nn.Parameter]:
+        if params_name == "all":
+            return list(self.model.parameters())
+        attr = getattr(self.model, params_name)
+        if not isinstance(attr, torch.nn.Module):
+            return list(attr)
+        return list(attr.parameters())
+
     def _define_optimizer(
         self,
         params_name: str,
         optimizer_base: Type[Optimizer],
         optimizer_config: Dict[str, Any],
-    ) -> Optimizer:
-        if params_name == "all":
-            parameters = self.model.parameters()
-        else:
-            attr = getattr(self.model, params_name)
-            if not isinstance(attr, torch.nn.Module):
-                parameters = attr
-            else:
-                parameters = attr.parameters()
+    ) -> Optional[Optimizer]:
+        parameters = self._group_parameters(params_name)
+        # sparse embeddings are always handled by `sparse_optimizer_key`
+        sparse_parameters = set(self.sparse_parameters)
+        if sparse_parameters:
+            parameters = [p for p in parameters if p not in sparse_parameters]
+            if not parameters:
+                return None
         opt = optimizer_base(parameters, **optimizer_config)
         self.optimizers[params_name] = opt
         return opt
 
+    def _define_scheduler(
+        self,
+        optimizer: Optimizer,
+        optimizer_config: Dict[str, Any],
+        scheduler: Optional[Union[str, Type[_LRScheduler]]],
+        scheduler_config: Dict[str, Any],
+    ) -> Optional[_LRScheduler]:
+        if scheduler is None:
+            return None
+        scheduler_config = shallow_copy_dict(scheduler_config)
+        default_lr_configs = self.default_lr_configs(optimizer, optimizer_config)
+        default_lr_config = None
+        if isinstance(scheduler, str):
+            default_lr_config = default_lr_configs.get(scheduler)
+        if default_lr_config is not None:
+            scheduler_config = update_dict(scheduler_config, default_lr_config)
+        if scheduler == "warmup":
+            sab = scheduler_config.get("scheduler_afterwards_base", "plateau")
+            if sab == "warmup":
+                raise ValueError("warmup should not be used inside a warmup")
+            sac = scheduler_config.get("scheduler_afterwards_config", {})
+            default_lr_config = default_lr_configs.get(sab)
+            sac = update_dict(sac, default_lr_config or {})
+            sab = scheduler_dict[sab]
+            scheduler_config["scheduler_afterwards_base"] = sab
+            scheduler_config["scheduler_afterwards_config"] = sac
+        if isinstance(scheduler, str):
+            scheduler = scheduler_dict[scheduler]
+        return scheduler(optimizer, **scheduler_config)
+
     def _init_optimizers(self) -> None:
         optimizers_settings = self.config.setdefault("optimizers", {"all": {}})
         self.optimizers: Dict[str, Optimizer] = {}
@@ -694,27 +796,40 @@ class Trainer(MonitoredMixin):
             opt = self._define_optimizer(params_name, optimizer_base, optimizer_config)
             self.config["optimizer_config"] = optimizer_config
             self._optimizer_type = optimizer
-            # scheduler
-            default_lr_configs = self.default_lr_configs(opt, optimizer_config)
-            default_lr_config = default_lr_configs.get(scheduler)
-            if default_lr_config is not None:
-                scheduler_config = update_dict(scheduler_config, default_lr_config)
-            if scheduler == "warmup":
-                sab = scheduler_config.get("scheduler_afterwards_base", "plateau")
-                if sab == "warmup":
-                    raise ValueError("warmup should not be used inside a warmup")
-                sac = scheduler_config.get("scheduler_afterwards_config", {})
-                default_lr_config = default_lr_configs.get(sab)
-                sac = update_dict(sac, default_lr_config or {})
-                sab = scheduler_dict[sab]
-                scheduler_config["scheduler_afterwards_base"] = sab
-                scheduler_config["scheduler_afterwards_config"] = sac
-            if scheduler is None:
-                self.schedulers[params_name] = None
-            else:
-                if isinstance(scheduler, str):
-                    scheduler = scheduler_dict[scheduler]
-                self.schedulers[params_name] = scheduler(opt, **scheduler_config)
+            # the group only contains sparse embeddings
+            if opt is None:
+                continue
+            self.schedulers[params_name] = self._define_scheduler(
+                opt,
+                optimizer_config,
+                scheduler,
+                scheduler_config,
+            )
+        # sparse embeddings emit sparse gradients, so they need their own optimizer,
+        # which follows the lr & scheduler settings of the (first) group they belong to
+        sparse_parameters = self.sparse_parameters
+        if sparse_parameters and self.sparse_optimizer_key not in self.optimizers:
+            sparse_set = set(sparse_parameters)
+            owner_setting: Dict[str, Any] = {}
+            for params_name, opt_setting in optimizers_settings.items():
+                group_parameters = self._group_parameters(params_name)
+                if any(p in sparse_set for p in group_parameters):
+                    owner_setting = opt_setting
+                    break
+            owner_lr = owner_setting.get("optimizer_config", {}).get("lr", default_lr)
+            optimizer = self.config.setdefault("sparse_optimizer", "sparse_adam")
+            optimizer_config = self.config.setdefault("sparse_optimizer_config", {})
+            optimizer_config.setdefault("lr", owner_lr)
+            if isinstance(optimizer, str):
+                optimizer = optimizer_dict[optimizer]
+            sparse_opt = optimizer(sparse_parameters, **optimizer_config)
+            self.optimizers[self.sparse_optimizer_key] = sparse_opt
+            self.schedulers[self.sparse_optimizer_key] = self._define_scheduler(
+                sparse_opt,
+                optimizer_config,
+                owner_setting.get("scheduler"),
+                owner_setting.get("scheduler_config", {}),
+            )
         self.schedulers_requires_metric = set()
         for key, scheduler in self.schedulers.items():
             if scheduler is None:
@@ -806,9 +921,18 @@ class Trainer(MonitoredMixin):
             return False
         return self.tqdm_settings.use_tqdm_in_cv or self.state.is_terminate
 
+    @property
+    def sparse_parameters(self) -> List[torch.nn.Parameter]:
+        encoder = getattr(self.model, "encoder", None)
+        if encoder is None:
+            return []
+        return encoder.sparse_parameters
+
     def _clip_norm_step(self) -> None:
+        sparse_parameters = set(self.sparse_parameters)
         self._gradient_norm = torch.nn.utils.clip_grad_norm_(
-            self.model.parameters(), self.clip_norm
+            [p for p in self.model.parameters() if p not in sparse_parameters],
+            self.clip_norm,
         )
 
     def _optimizer_step(self) -> None:
@@ -817,8 +941,9 @@ class Trainer(MonitoredMixin):
                 opt.step()
             else:
                 self.grad_scaler.step(opt)
-                self.grad_scaler.update()
             opt.zero_grad()
+        if self.grad_scaler is not None:
+            self.grad_scaler.update()
 
     def _get_scheduler_settings(
         self,
@@ -933,7 +1058,7 @@ class Trainer(MonitoredMixin):
         return MonitorResults(terminate, outputs)
 
     def on_save_checkpoint(self, score: float) -> None:
-        self.save_checkpoint(score)
+        self.save_checkpoint(score, blocking=False)
 
     def _finalize(self, step_outputs: StepOutputs) -> None:
         if self.model.use_ema:
@@ -1012,15 +1137,18 @@ class Trainer(MonitoredMixin):
         *,
         enable_prefetch: bool = True,
     ) -> None:
+        cpu_prefetch_depth = self.cpu_prefetch_depth
         self.tr_loader = PrefetchLoader(
             tr_loader,
             self.device,
             enable_prefetch=enable_prefetch,
+            cpu_prefetch_depth=cpu_prefetch_depth,
         )
         self.tr_loader_copy = PrefetchLoader(
             tr_loader_copy,
             self.device,
             enable_prefetch=enable_prefetch,
+            cpu_prefetch_depth=cpu_prefetch_depth,
         )
         self.cv_loader: Optional[PrefetchLoader]
         if cv_loader is None:
@@ -1030,6 +1158,7 @@ class Trainer(MonitoredMixin):
                 cv_loader,
                 self.device,
                 enable_prefetch=enable_prefetch,
+                cpu_prefetch_depth=cpu_prefetch_depth,
             )
         self.state.inject_loader(tr_loader)
         # sample weights
@@ -1090,6 +1219,7 @@ class Trainer(MonitoredMixin):
                 )
                 terminate = True
             if terminate:
+                self.tr_loader.close()
                 if os.path.isdir(self.checkpoint_folder):
                     if not self.deepspeed:
                         self.log_msg(  # type: ignore
@@ -1115,6 +1245,7 @@ class Trainer(MonitoredMixin):
         self._log_metrics_msg(self.final_results)
         if not has_ckpt:
             self.save_checkpoint(self.final_results.final_score)
+        self.wait_checkpoints()
 
     def get_metrics(
         self,
@@ -1219,23 +1350,59 @@ class Trainer(MonitoredMixin):
             decayed_metrics,
         )
 
-    def save_checkpoint(self, score: float, folder: Optional[str] = None) -> None:
+    def save_checkpoint(
+        self,
+        score: float,
+        folder: Optional[str] = None,
+        *,
+        blocking: bool = True,
+    ) -> None:
         if folder is None:
             folder = self.checkpoint_folder
+        file = f"{self.model.pt_prefix}{self.state.epoch}.pt"
+        writer = self._checkpoint_writer
+        if writer is None or blocking:
+            self.wait_checkpoints()
+            self._write_checkpoint(self.model.state_dict(), score, folder, file)
+            return
+        # snapshot to cpu, so the training could go on while writing
+        states = {
+            k: v.detach().to("cpu", copy=True) if isinstance(v, torch.Tensor) else v
+            for k, v in self.model.state_dict().items()
+        }
+        writer.submit(partial(self._write_checkpoint, states, score, folder, file))
+
+    def _write_checkpoint(
+        self,
+        states: Dict[str, Any],
+        score: float,
+        folder: str,
+        file: str,
+    ) -> None:
         # leave top_k snapshots only
         if self.state.max_snapshot_file > 0:
             checkpoints = self.model.sorted_checkpoints(folder)
             if len(checkpoints) >= self.state.max_snapshot_file:
-                for file in checkpoints[self.state.max_snapshot_file - 1 :]:
-                    self.checkpoint_scores.pop(file)
-                    os.remove(os.path.join(folder, file))
+                for ckpt_file in checkpoints[self.state.max_snapshot_file - 1 :]:
+                    self.checkpoint_scores.pop(ckpt_file)
+                    os.remove(os.path.join(folder, ckpt_file))
         # pt
-        file = f"{self.model.pt_prefix}{self.state.epoch}.pt"
-        torch.save(self.model.state_dict(), os.path.join(folder, file))
+        _atomic_write(
+            os.path.join(folder, file),
+            lambda path: torch.save(states, path),
+        )
         # scores
         self.checkpoint_scores[file] = score
-        with open(os.path.join(folder, self.model.scores_file), "w") as f:
-            json.dump(self.checkpoint_scores, f)
+
+        def _dump_scores(path: str) -> None:
+            with open(path, "w") as f:
+                json.dump(self.checkpoint_scores, f)
+
+        _atomic_write(os.path.join(folder, self.model.scores_file), _dump_scores)
+
+    def wait_checkpoints(self) -> None:
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
 
     def restore_checkpoint(
         self,
@@ -1245,6 +1412,7 @@ class Trainer(MonitoredMixin):
     ) -> bool:
         if folder is None:
             folder = self.checkpoint_folder
+        self.wait_checkpoints()
         return self.model.restore_checkpoint(folder, strict, state_dict_callback)
 
 
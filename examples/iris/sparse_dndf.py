@@ -0,0 +1,23 @@
+import os
+import time
+import cflearn
+
+from cflearn.modules.blocks import DNDF
+
+if __name__ == "__main__":
+    file_folder = os.path.dirname(__file__)
+    iris_data_file = os.path.join(file_folder, "iris.data")
+
+    for model in ["tree_dnn", "tree_stack"]:
+        m = cflearn.make(model).fit(iris_data_file)
+        dndf_list = [module for module in m.model.modules() if isinstance(module, DNDF)]
+        for top_k, threshold in [(None, None), (8, None), (4, None), (None, 0.01)]:
+            for dndf in dndf_list:
+                dndf.set_sparse_inference(top_k, threshold)
+            t = time.time()
+            for _ in range(10):
+                m.predict(iris_data_file, contains_labels=True)
+            latency = (time.time() - t) / 10
+            print(f"{model} | top_k={top_k}, threshold={threshold} | {latency:.4f}s")
+            cflearn.evaluate(iris_data_file, pipelines=m)
+    cflearn._rmtree("_logs")
@@ -105,6 +105,15 @@ def test_ops() -> None:
         labels = labels.reshape([-1, num_history + 1])[..., -2:].reshape([-1, 1])
         print(np.hstack([predictions, labels]))
 
+        if model in ["rnn", "transformer"]:
+            # rolling forecasts, one step of every case at a time
+            x_te = np.array(m.data.read_file(te_file)[0], dtype=object)
+            x_te = x_te.reshape([num_case, num_history + 1, -1])
+            for i in range(num_history + 1):
+                streamed = m.predict_next(x_te[:, i], series_ids=x_te[:, i, 0])
+            m.reset_stream()
+            print(np.hstack([streamed, predictions[1::2]]))
+
 
 if __name__ == "__main__":
     test_ops()
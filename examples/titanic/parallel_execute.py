@@ -0,0 +1,27 @@
+import time
+import torch
+import cflearn
+
+import numpy as np
+
+# for reproduction
+np.random.seed(142857)
+torch.manual_seed(142857)
+
+data_config = {"label_name": "Survived"}
+
+for model in ["tree_dnn", "wnd"]:
+    m = cflearn.make(model, data_config=data_config).fit("train.csv")
+    model_ins = m.model.eval()
+    x = m.tr_data.processed.x
+    for batch_size in [1, 64, len(x)]:
+        split = model_ins.get_split(x[:batch_size], m.device)
+        for parallel in [False, True]:
+            model_ins._parallel_execute = parallel
+            with torch.no_grad():
+                t = time.time()
+                for _ in range(100):
+                    model_ins.execute(split)
+            latency = (time.time() - t) / 100
+            print(f"{model} | batch={batch_size}, parallel={parallel} | {latency:.6f}s")
+    model_ins.shutdown_executor()
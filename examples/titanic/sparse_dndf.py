@@ -0,0 +1,26 @@
+import time
+import torch
+import cflearn
+
+import numpy as np
+
+from cflearn.modules.blocks import DNDF
+
+# for reproduction
+np.random.seed(142857)
+torch.manual_seed(142857)
+
+data_config = {"label_name": "Survived"}
+
+for model in ["tree_dnn", "tree_stack"]:
+    m = cflearn.make(model, data_config=data_config).fit("train.csv")
+    dndf_list = [module for module in m.model.modules() if isinstance(module, DNDF)]
+    for top_k, threshold in [(None, None), (8, None), (4, None), (None, 0.01)]:
+        for dndf in dndf_list:
+            dndf.set_sparse_inference(top_k, threshold)
+        t = time.time()
+        for _ in range(10):
+            m.predict("train.csv", contains_labels=True)
+        latency = (time.time() - t) / 10
+        print(f"{model} | top_k={top_k}, threshold={threshold} | {latency:.4f}s")
+        cflearn.evaluate("train.csv", pipelines=m, contains_labels=True)
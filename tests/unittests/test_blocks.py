@@ -4,6 +4,7 @@ import unittest
 
 import numpy as np
 import torch.nn as nn
+import torch.nn.functional as F
 
 from cflearn.modules.blocks import *
 
@@ -42,6 +43,26 @@ class TestBlocks(unittest.TestCase):
 
         self.assertTrue(torch.allclose(probabilities.sum(1), torch.ones(batch_size)))
 
+    def test_dndf_indices_cache(self) -> None:
+        input_dim = 256
+        output_dim = 16
+
+        dndf = DNDF(input_dim, output_dim)
+        net = torch.randn(32, input_dim)
+        with torch.no_grad():
+            probabilities = dndf(net)
+            flat_indices = dndf._indices_cache[32, net.device]
+            self.assertIs(flat_indices, dndf._get_flat_indices(32, net.device))
+            self.assertTrue(torch.equal(probabilities, dndf(net)))
+            # the cache is bounded by bytes, and too large entries are not cached
+            num_bytes = flat_indices.numel() * flat_indices.element_size()
+            dndf.indices_cache_bytes = num_bytes
+            dndf(torch.randn(16, input_dim))
+            self.assertEqual(list(dndf._indices_cache), [(16, net.device)])
+            dndf(torch.randn(64, input_dim))
+            self.assertEqual(list(dndf._indices_cache), [(16, net.device)])
+        self.assertNotIn("_indices_cache", dndf.state_dict())
+
     def test_fast_dndf(self) -> None:
         def loss_function(outputs):
             return -outputs[range(batch_size), labels].mean()
@@ -82,6 +103,67 @@ class TestBlocks(unittest.TestCase):
             print(f"slow : {slow_t} ; fast : {fast_t}")
             self.assertTrue(fast_t < slow_t)
 
+    def test_low_memory_dndf(self) -> None:
+        def loss_function(outputs):
+            return -outputs[range(batch_size), labels].mean()
+
+        def run(dndf):
+            net = torch.empty_like(inp).requires_grad_(True)
+            net.data = inp.data
+            t = time.time()
+            outputs = dndf(net)
+            loss_function(outputs).backward()
+            return outputs, net.grad, time.time() - t
+
+        d = 128
+        k = 10
+        batch_size = 256
+
+        for depth in range(3, 9):
+            inp = torch.randn(batch_size, d)
+            labels = torch.randint(k, [batch_size])
+            dndf = DNDF(d, k, tree_depth=depth)
+            dndf_low = DNDF(d, k, tree_depth=depth, low_memory=True)
+            dndf_low.load_state_dict(dndf.state_dict())
+            o1, g1, fast_t = run(dndf)
+            o2, g2, low_t = run(dndf_low)
+            self.assertTrue(torch.allclose(o1, o2, atol=1e-6))
+            self.assertTrue(torch.allclose(g1, g2, atol=1e-6))
+            print(f"depth {depth} | fast : {fast_t} ; low memory : {low_t}")
+
+    def test_sparse_dndf(self) -> None:
+        input_dim = 256
+        batch_size = 32
+
+        net = torch.randn(batch_size, input_dim)
+        for output_dim in [1, 16]:
+            dndf = DNDF(input_dim, output_dim).eval()
+            num_leaf = dndf._num_leaf
+            with torch.no_grad():
+                dense = dndf(net)
+                for top_k, threshold in [(num_leaf, None), (None, 0.0)]:
+                    dndf.set_sparse_inference(top_k, threshold)
+                    self.assertTrue(torch.allclose(dense, dndf(net), atol=1e-6))
+                for top_k, threshold in [(4, None), (None, 0.05), (4, 0.05)]:
+                    dndf.set_sparse_inference(top_k, threshold)
+                    sparse = dndf(net)
+                    self.assertEqual(sparse.shape, dense.shape)
+                    if output_dim > 1:
+                        ones = torch.ones(batch_size)
+                        self.assertTrue(torch.allclose(sparse.sum(1), ones))
+                # pruning starts at the last level when `top_k` >= num_leaf / 2
+                tree_net = dndf.tree_proj(net)
+                full_routes = dndf._pruned_route(tree_net, num_leaf)[0]
+                self.assertTrue(torch.allclose(full_routes.sum(-1), torch.ones(1)))
+                top_k = num_leaf // 2
+                expected = full_routes.topk(top_k, dim=-1)[0]
+                pruned = dndf._pruned_route(tree_net, top_k)[0]
+                self.assertTrue(torch.allclose(pruned, expected))
+                dndf.train()
+                self.assertTrue(torch.allclose(dense, dndf(net)))
+        with self.assertRaises(ValueError):
+            dndf.set_sparse_inference(num_leaf + 1)
+
     def test_invertible(self) -> None:
         dim = 512
         batch_size = 32
@@ -175,6 +257,11 @@ class TestBlocks(unittest.TestCase):
 
         self.assertTrue(torch.allclose(permute(torch_output), output))
 
+        fused = attention(q, k, v, mask=mask, return_weights=False)
+        self.assertTrue(torch.allclose(output, fused.output, atol=1e-5))
+        if hasattr(F, "scaled_dot_product_attention"):
+            self.assertIsNone(fused.weights)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,279 @@
+import gc
+import os
+import torch
+import shutil
+import cflearn
+import unittest
+
+import numpy as np
+
+from types import SimpleNamespace
+from cfdata.tabular import TimeSeriesConfig
+from cflearn.data import TabularData
+from cflearn.data import TabularLoader
+from cflearn.data import TabularSampler
+from cflearn.data import MemmapTabularData
+from cflearn.data import StreamingTabularData
+from cflearn.protocol import PrefetchLoader
+from cflearn.misc.time_series import TSLabelCollator
+
+
+class TestData(unittest.TestCase):
+    def test_tensor_cache(self) -> None:
+        x = np.random.random([1000, 10])
+        y = np.random.randint(0, 3, [1000, 1])
+        data = TabularData(task_type="clf", verbose_level=0).read(x, y)
+        for shuffle in [False, True]:
+            np.random.seed(142857)
+            sampler = TabularSampler(data, shuffle=shuffle, verbose_level=0)
+            loader = TabularLoader(128, sampler, return_indices=True)
+            np.random.seed(142857)
+            sampler = TabularSampler(data, shuffle=shuffle, verbose_level=0)
+            cached = TabularLoader(
+                128,
+                sampler,
+                return_indices=True,
+                use_tensor_cache=True,
+            )
+            self.assertTrue(cached.use_tensor_cache)
+            self.assertEqual(len(list(loader)), len(list(cached)))
+            np.random.seed(142857)
+            batches = list(loader)
+            np.random.seed(142857)
+            cached_batches = list(cached)
+            for (b1, i1), (b2, i2) in zip(batches, cached_batches):
+                self.assertTrue(np.allclose(i1, i2))
+                self.assertTrue(torch.allclose(b1["x_batch"], b2["x_batch"]))
+                self.assertTrue(torch.equal(b1["labels"], b2["labels"]))
+                self.assertEqual(b2["labels"].dtype, torch.long)
+
+    def test_ts_tensor_cache(self) -> None:
+        num_id, num_step, num_history = 8, 40, 5
+        ids = np.repeat(np.arange(num_id), num_step)[..., None]
+        steps = np.tile(np.arange(num_step), num_id)[..., None]
+        x = np.hstack([ids, steps, np.random.random([num_id * num_step, 3])])
+        y = np.random.randint(0, 3, [len(x), 1])
+        ts_config = TimeSeriesConfig(id_column_idx=0, time_column_idx=1)
+        data = TabularData(
+            task_type="ts_clf",
+            time_series_config=ts_config,
+            verbose_level=0,
+        ).read(x, y)
+        collator = TSLabelCollator(data, {"num_history": 2})
+        aggregation_config = {"num_history": num_history}
+        loaders = []
+        for use_tensor_cache in [False, True]:
+            np.random.seed(142857)
+            sampler = TabularSampler(
+                data,
+                shuffle=True,
+                aggregation="continuous",
+                aggregation_config=aggregation_config,
+                verbose_level=0,
+            )
+            loader = TabularLoader(
+                32,
+                sampler,
+                return_indices=True,
+                label_collator=collator,
+                use_tensor_cache=use_tensor_cache,
+            )
+            self.assertEqual(loader.use_tensor_cache, use_tensor_cache)
+            loaders.append(loader)
+        loader, cached = loaders
+        # only the raw rows are cached, windows are gathered per batch
+        assert cached._x_cache is not None
+        self.assertEqual(cached._x_cache.shape[0], len(x))
+        np.random.seed(142857)
+        batches = list(loader)
+        np.random.seed(142857)
+        cached_batches = list(cached)
+        self.assertEqual(len(batches), len(cached_batches))
+        for (b1, i1), (b2, i2) in zip(batches, cached_batches):
+            self.assertTrue(np.array_equal(i1, i2))
+            self.assertEqual(b2["x_batch"].shape[1], num_history)
+            self.assertTrue(torch.allclose(b1["x_batch"], b2["x_batch"]))
+            self.assertTrue(torch.equal(b1["labels"], b2["labels"]))
+
+    def test_parallel_read(self) -> None:
+        n = 500
+        columns = [
+            np.random.random(n).tolist(),
+            np.random.randint(0, 10, n).tolist(),
+            [f"s{i}" for i in np.random.randint(0, 20, n)],
+            [1.0] * n,
+            np.random.random(n).tolist(),
+        ]
+        x = list(map(list, zip(*columns)))
+        y = np.random.randint(0, 3, [n, 1])
+        serial = TabularData(task_type="clf", verbose_level=0).read(x, y)
+        for backend in ["thread", "process"]:
+            data = TabularData(
+                task_type="clf",
+                verbose_level=0,
+                num_jobs=2,
+                parallel_backend=backend,
+            ).read(x, y)
+            self.assertEqual(data.excludes, serial.excludes)
+            self.assertEqual(sorted(data.processors), sorted(serial.processors))
+            self.assertTrue(np.allclose(data.converted.x, serial.converted.x))
+            self.assertTrue(np.allclose(data.processed.x, serial.processed.x))
+            self.assertTrue(np.array_equal(data.processed.y, serial.processed.y))
+            transformed = data.transform(x, None, contains_labels=False).x
+            expected = serial.transform(x, None, contains_labels=False).x
+            self.assertTrue(np.allclose(transformed, expected))
+
+    def test_cpu_prefetch(self) -> None:
+        x = np.random.random([1000, 10])
+        y = np.random.random([1000, 1])
+        data = TabularData(task_type="reg", verbose_level=0).read(x, y)
+        sampler = TabularSampler(data, shuffle=False, verbose_level=0)
+        loader = TabularLoader(128, sampler, return_indices=True)
+        plain = PrefetchLoader(loader, "cpu")
+        batches = list(plain)
+        prefetch = PrefetchLoader(loader.copy(), "cpu", cpu_prefetch_depth=2)
+        self.assertTrue(prefetch.use_cpu_prefetch)
+        for _ in range(2):
+            prefetched = list(prefetch)
+            self.assertEqual(len(batches), len(prefetched))
+            for (b1, i1), (b2, i2) in zip(batches, prefetched):
+                self.assertTrue(torch.equal(i1, i2))
+                self.assertTrue(np.allclose(b1["x_batch"], b2["x_batch"]))
+            self.assertIsNone(prefetch._worker)
+        # early stopping should release the background worker
+        for i, _ in enumerate(prefetch):
+            if i == 2:
+                break
+        self.assertIsNotNone(prefetch._worker)
+        prefetch.close()
+        self.assertIsNone(prefetch._worker)
+        self.assertEqual(len(list(prefetch)), len(batches))
+
+    def test_memmap_data(self) -> None:
+        x = np.random.random([1000, 10])
+        y = np.random.randint(0, 3, [1000, 1])
+        mmap_folder = "__mmap__"
+        data = MemmapTabularData(
+            task_type="clf",
+            verbose_level=0,
+            mmap_folder=mmap_folder,
+        ).read(x, y)
+        self.assertIsInstance(data.processed.x, np.memmap)
+        self.assertIsInstance(data.processed.y, np.memmap)
+        split = data.split(100)
+        self.assertIsInstance(split.split.processed.x, np.memmap)
+        self.assertIsInstance(split.remained.processed.x, np.memmap)
+        self.assertIs(split.split._mmap_handle, split.remained._mmap_handle)
+        expected_x = data.processed.x[split.split_indices]
+        self.assertTrue(np.allclose(split.split.processed.x, expected_x))
+        sampler = TabularSampler(split.remained, shuffle=True, verbose_level=0)
+        loader = TabularLoader(128, sampler)
+        self.assertEqual(sum(len(b["x_batch"]) for b in loader), 900)
+        export_folder = "__mmap_data__"
+        for compress in [False, True]:
+            data.save(export_folder, compress=compress)
+            loaded = MemmapTabularData.load(export_folder, compress=compress)
+            self.assertIsInstance(loaded.processed.x, np.memmap)
+            if compress:
+                os.remove(f"{export_folder}.zip")
+            else:
+                shutil.rmtree(export_folder)
+            # loaded data should not depend on the exported files
+            self.assertTrue(np.allclose(loaded.processed.x, data.processed.x))
+            self.assertTrue(np.array_equal(loaded.processed.y, data.processed.y))
+        shutil.rmtree(mmap_folder)
+        # temporary folders should be removed along with the data
+        data = MemmapTabularData(task_type="clf", verbose_level=0).read(x, y)
+        split = data.split(100)
+        handles = [data._mmap_handle, split.split._mmap_handle]
+        folders = [handle.path for handle in handles]  # type: ignore
+        self.assertTrue(all(map(os.path.isdir, folders)))
+        del data, split, sampler, loader, loaded, handles
+        gc.collect()
+        self.assertFalse(any(map(os.path.isdir, folders)))
+
+    def test_streaming_data(self) -> None:
+        x = np.random.random([1000, 4])
+        y = (x[..., :1] > 0.5).astype(np.int64)
+        file = "__streaming__.csv"
+        with open(file, "w") as f:
+            f.write("a,b,c,d,label\n")
+            for row, label in zip(x, y):
+                f.write(",".join(map(str, row.tolist() + label.tolist())) + "\n")
+        mmap_folder = "__mmap__"
+        full = TabularData(task_type="clf", verbose_level=0).read(file)
+        for source, labels in [(file, None), (x, y)]:
+            kwargs = {"task_type": "clf", "verbose_level": 0, "chunk_size": 128}
+            kwargs["mmap_folder"] = mmap_folder
+            data = StreamingTabularData(fit_size=None, **kwargs).read(source, labels)
+            self.assertIsInstance(data.processed.x, np.memmap)
+            self.assertTrue(np.allclose(data.processed.x, full.processed.x, atol=1e-5))
+            self.assertTrue(np.array_equal(data.processed.y, full.processed.y))
+            data = StreamingTabularData(fit_size=300, **kwargs).read(source, labels)
+            self.assertEqual(len(data.raw.x), 300)
+            self.assertEqual(len(data), 1000)
+            split = data.split(100, order="bottom_up")
+            self.assertEqual(len(split.remained), 900)
+            split_x = split.split.processed.x
+            self.assertTrue(np.allclose(split_x, data.processed.x[-100:]))
+            self.assertTrue(np.shares_memory(split_x, data.processed.x))
+        os.remove(file)
+        shutil.rmtree(mmap_folder)
+
+    def test_streaming_fit(self) -> None:
+        x = np.random.random([2000, 4])
+        y = (x[..., :1] > 0.5).astype(np.int64)
+        # a class which is very likely to be absent from the reservoir sample
+        y[-1] = 2
+        m = cflearn.make(
+            "linear",
+            data_protocol="tabular_stream",
+            data_config={"fit_size": 300, "chunk_size": 256},
+            task_type="clf",
+            max_epoch=2,
+            use_tqdm=False,
+            verbose_level=0,
+        ).fit(x, y)
+        self.assertEqual(m.data.num_classes, 3)
+        self.assertEqual(len(m.tr_data) + len(m.cv_data), 2000)
+        # the single sample of the rare class should be picked into cv
+        cv_labels = np.unique(m.cv_data.processed.y).tolist()
+        self.assertEqual(cv_labels, [0, 1, 2])
+        self.assertEqual(m.predict(x).shape, (2000, 1))
+        cflearn._rmtree("_logs")
+
+    def test_ts_label_collator(self) -> None:
+        num_classes = 4
+        data = SimpleNamespace(is_reg=False, num_classes=num_classes)
+        collator = TSLabelCollator(data, {"num_history": 5})  # type: ignore
+        labels = np.random.randint(0, num_classes, [64, 7, 1])
+        expected = []
+        for sample in labels[:, -5:, 0]:
+            counts = np.bincount(sample, minlength=num_classes)
+            expected.append([counts.argmax()])
+        collated = collator(labels)
+        self.assertTrue(np.array_equal(collated, np.array(expected)))
+        tensor_collated = collator(torch.from_numpy(labels))
+        self.assertIsInstance(tensor_collated, torch.Tensor)
+        self.assertTrue(np.array_equal(tensor_collated.numpy(), collated))
+        # non-vectorized custom methods always receive numpy arrays
+        received = []
+
+        @TSLabelCollator.register("_test_first")
+        def _first(labels_: np.ndarray) -> np.ndarray:
+            received.append(type(labels_))
+            return labels_[..., 0, :]
+
+        collator = TSLabelCollator(data, {"method": "_test_first"})  # type: ignore
+        self.assertFalse(collator.vectorized)
+        first = collator(torch.from_numpy(labels))
+        self.assertIsInstance(first, torch.Tensor)
+        self.assertEqual(received, [np.ndarray])
+        TSLabelCollator.register("_test_first", vectorized=True)(_first)
+        self.assertTrue(collator.vectorized)
+        TSLabelCollator.custom_methods.pop("_test_first")
+        TSLabelCollator.vectorized_methods.discard("_test_first")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,205 @@
+import torch
+import cflearn
+import unittest
+
+import numpy as np
+import torch.nn.functional as F
+
+from typing import Any
+from typing import Dict
+from typing import Tuple
+from unittest import mock
+from cflearn.misc.toolkit import to_torch
+from cflearn.modules.encoders import Encoder
+from cflearn.modules.encoders import EncodingResult
+from cflearn.modules.transform.core import SplitFeatures
+
+
+class TestEncoders(unittest.TestCase):
+    @staticmethod
+    def _get_data() -> Tuple[np.ndarray, np.ndarray]:
+        x = np.random.random([1000, 4])
+        x[..., 0] = np.random.randint(0, 5, 1000)
+        x[..., 1] = np.random.randint(0, 8, 1000)
+        y = np.random.random([1000, 1])
+        return x, y
+
+    def test_one_hot_cache(self) -> None:
+        x, y = self._get_data()
+        kwargs = {"max_epoch": 1, "use_tqdm": False, "verbose_level": 0}
+        m = cflearn.make("fcnn", **kwargs).fit(x, y)
+        encoder = m.model.encoder
+        x_batch = to_torch(m.tr_data.processed.x)
+        cache = encoder._get_cache("tr", x_batch.device)
+        self.assertEqual(cache["one_hot"].dtype, torch.int8)
+        self.assertNotIn("tr_one_hot_cache", encoder.state_dict())
+        indices = np.arange(len(x_batch))
+        with torch.no_grad():
+            cached = encoder(x_batch.clone(), indices, "tr").one_hot
+            expected = encoder(x_batch.clone(), None, None).one_hot
+        self.assertEqual(cached.dtype, torch.float32)
+        self.assertTrue(torch.equal(cached, expected))
+        columns = x_batch[..., encoder.one_hot_columns].to(torch.long)
+        one_hot_dims = encoder.input_dims[encoder._one_hot_indices].tolist()
+        looped = torch.cat(
+            [
+                F.one_hot(column, int(dim)).to(torch.float32)
+                for column, dim in zip(columns.t().unbind(), one_hot_dims)
+            ],
+            dim=1,
+        )
+        self.assertTrue(torch.equal(cached, looped))
+        # least recently used caches are evicted beyond the budget
+        encoder.clear_caches()
+        encoder._get_cache("tr", x_batch.device)
+        encoder._cache_budget = encoder.cache_nbytes / 1024 ** 2
+        encoder._get_cache("cv", x_batch.device)
+        self.assertEqual(list(encoder._caches), ["cv"])
+        encoder._get_cache("tr", x_batch.device)
+        self.assertEqual(list(encoder._caches), ["tr"])
+        cflearn._rmtree("_logs")
+
+    def test_hashed_embedding(self) -> None:
+        x, y = self._get_data()
+        for use_fast_embedding in [True, False]:
+            m = cflearn.make(
+                "fcnn",
+                max_epoch=1,
+                use_tqdm=False,
+                verbose_level=0,
+                model_config={
+                    "default_encoding_method": "hashed_embedding",
+                    "default_encoding_configs": {"num_buckets": 4, "num_hashes": 2},
+                    "encoder_config": {"use_fast_embedding": use_fast_embedding},
+                },
+            ).fit(x, y)
+            encoder = m.model.encoder.eval()
+            num_weights = sum(e.weights.shape[0] for e in encoder.embeddings)
+            self.assertEqual(num_weights, 8)
+            self.assertTrue(torch.isinf(encoder.oob_bounds).all())
+            x_batch = to_torch(m.tr_data.processed.x)
+            indices = np.arange(len(x_batch))
+            with torch.no_grad():
+                cached = encoder(x_batch.clone(), indices, "tr").embedding
+                expected = encoder(x_batch.clone(), None, None).embedding
+            self.assertEqual(cached.shape[1], encoder.embedding_dim)
+            self.assertTrue(torch.allclose(cached, expected))
+        # by default, the tables of (5, 8) categories are halved
+        m = cflearn.make(
+            "fcnn",
+            max_epoch=1,
+            use_tqdm=False,
+            verbose_level=0,
+            model_config={"default_encoding_method": "hashed_embedding"},
+        ).fit(x, y)
+        encoder = m.model.encoder
+        self.assertEqual(encoder.embeddings[0].weights.shape[0], 3 + 4)
+        self.assertEqual(encoder._num_lookups, 4)
+        # and they are bounded by `max_hash_buckets`
+        with mock.patch.object(Encoder, "max_hash_buckets", 3):
+            m = cflearn.make(
+                "fcnn",
+                max_epoch=1,
+                use_tqdm=False,
+                verbose_level=0,
+                model_config={"default_encoding_method": "hashed_embedding"},
+            ).fit(x, y)
+        self.assertEqual(m.model.encoder.embeddings[0].weights.shape[0], 3 + 3)
+        cflearn._rmtree("_logs")
+
+    def _fit_sparse_embedding(self, **kwargs: Any) -> cflearn.Pipeline:
+        x, y = self._get_data()
+        m = cflearn.make(
+            "fcnn",
+            max_epoch=1,
+            use_tqdm=False,
+            verbose_level=0,
+            model_config={
+                "default_encoding_method": "embedding",
+                "encoder_config": {"sparse_embedding": True},
+            },
+            **kwargs,
+        ).fit(x, y)
+        sparse_parameters = m.model.encoder.sparse_parameters
+        self.assertEqual(len(sparse_parameters), 1)
+        optimizers = m.trainer.optimizers
+        sparse_optimizer = optimizers[m.trainer.sparse_optimizer_key]
+        self.assertIsInstance(sparse_optimizer, torch.optim.SparseAdam)
+        for optimizer in optimizers.values():
+            params = [p for group in optimizer.param_groups for p in group["params"]]
+            contained = any(p is sparse_parameters[0] for p in params)
+            self.assertEqual(contained, optimizer is sparse_optimizer)
+        return m
+
+    def test_sparse_embedding(self) -> None:
+        m = self._fit_sparse_embedding()
+        schedulers = m.trainer.schedulers
+        sparse_scheduler = schedulers[m.trainer.sparse_optimizer_key]
+        self.assertIs(type(sparse_scheduler), type(schedulers["all"]))
+        cflearn._rmtree("_logs")
+
+    def test_sparse_embedding_groups(self) -> None:
+        def _setting(scheduler: str) -> Dict[str, Any]:
+            return {
+                "optimizer": "adam",
+                "scheduler": scheduler,
+                "optimizer_config": {},
+                "scheduler_config": {},
+            }
+
+        # sparse embeddings are split out of user defined groups as well, and they
+        # follow the settings of the group which they belong to
+        optimizers = {"encoder": _setting("step"), "heads": _setting("plateau")}
+        m = self._fit_sparse_embedding(optimizers=optimizers)
+        trainer = m.trainer
+        # the `encoder` group only contains the sparse embedding
+        self.assertNotIn("encoder", trainer.optimizers)
+        self.assertIn("heads", trainer.optimizers)
+        sparse_scheduler = trainer.schedulers[trainer.sparse_optimizer_key]
+        self.assertIsInstance(sparse_scheduler, torch.optim.lr_scheduler.StepLR)
+        cflearn._rmtree("_logs")
+
+    def test_column_slices(self) -> None:
+        x, y = self._get_data()
+        kwargs = {"max_epoch": 1, "use_tqdm": False, "verbose_level": 0}
+        m = cflearn.make("fcnn", **kwargs).fit(x, y)
+        dimensions = m.model.dimensions
+        self.assertEqual(m.model.encoder._tgt_slice, slice(0, 2))
+        self.assertEqual(dimensions._numerical_slice, slice(2, 4))
+        x_batch = to_torch(m.tr_data.processed.x)
+        with torch.no_grad():
+            split = dimensions.split_features(x_batch, None, None)
+        numerical = split.numerical
+        self.assertEqual(numerical.data_ptr(), x_batch[..., 2:].data_ptr())
+        self.assertTrue(torch.equal(numerical, x_batch[..., [2, 3]]))
+        cflearn._rmtree("_logs")
+
+    def test_merged_cache(self) -> None:
+        numerical = torch.randn(32, 3)
+        one_hot = torch.randn(32, 5)
+        embedding = torch.randn(32, 4)
+        categorical = EncodingResult(one_hot, embedding)
+        split = SplitFeatures(categorical, numerical, {})
+        plain_split = SplitFeatures(categorical, numerical)
+        merged = split.merge()
+        self.assertTrue(torch.equal(merged, plain_split.merge()))
+        # adjacent pieces are sliced from the merged cache
+        for args in [(True, False, False), (True, True, True)]:
+            merged_view = split.merge(*args)
+            self.assertTrue(torch.equal(merged_view, plain_split.merge(*args)))
+            self.assertIs(merged_view._base, merged)
+        # single pieces are returned as is
+        self.assertIs(split.merge(True, False, True), one_hot)
+        self.assertIs(split.merge(False, True, True), embedding)
+        # numerical & embedding are not adjacent, so they are concatenated
+        self.assertTrue(
+            torch.equal(
+                split.merge(False, True, False),
+                torch.cat([numerical, embedding], dim=1),
+            )
+        )
+        self.assertIs(split.merge(False, False, False), numerical)
+
+
+if __name__ == "__main__":
+    unittest.main()
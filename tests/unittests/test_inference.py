@@ -0,0 +1,65 @@
+import os
+import cflearn
+import unittest
+
+import numpy as np
+
+from cflearn.data import TabularData
+from cflearn.inference import PreProcessor
+
+
+class TestInference(unittest.TestCase):
+    def test_predict_array(self) -> None:
+        x = np.random.random([1000, 4])
+        x[..., 0] = np.random.randint(0, 5, 1000)
+        y_reg = x[..., 1:2] + x[..., :1]
+        y_clf = (y_reg > y_reg.mean()).astype(np.int64)
+        kwargs = {"max_epoch": 2, "use_tqdm": False, "verbose_level": 0}
+        m = cflearn.make(**kwargs).fit(x, y_reg)
+        self.assertTrue(np.allclose(m.predict(x), m.predict_array(x), atol=1e-5))
+        m = cflearn.make(task_type="clf", **kwargs).fit(x, y_clf)
+        m.model.train()
+        self.assertTrue(np.array_equal(m.predict(x), m.predict_array(x)))
+        self.assertTrue(
+            np.allclose(
+                m.predict_prob(x),
+                m.predict_array(x, returns_probabilities=True),
+                atol=1e-5,
+            )
+        )
+        # the previous mode should be restored
+        self.assertTrue(m.model.training)
+        cflearn._rmtree("_logs")
+
+    def test_transform_tables(self) -> None:
+        n = 2000
+        numerical = np.random.random(n).tolist()
+        categorical = np.random.randint(0, 30, n).astype(np.float64)
+        categorical[:20] = np.nan
+        skewed = np.where(np.random.random(n) < 0.95, 1, np.random.randint(2, 500, n))
+        strings = [f"s{i}" for i in np.random.randint(0, 40, n)]
+        columns = [numerical, categorical.tolist(), strings, skewed.tolist()]
+        x = list(map(list, zip(*columns)))
+        y = np.random.random([n, 1])
+        data = TabularData(verbose_level=0).read(x, y)
+        preprocessor = PreProcessor(data, "tabular", "tabular", {})
+        self.assertEqual(sorted(preprocessor.transform_tables), [1, 2, 3])
+        # contains nan & unseen values
+        columns[1] = np.random.randint(-5, 40, n).astype(np.float64)
+        columns[1][:20] = np.nan
+        columns[1] = columns[1].tolist()
+        columns[2] = [f"s{i}" for i in np.random.randint(0, 60, n)]
+        columns[3] = np.random.randint(0, 600, n).tolist()
+        x_new = list(map(list, zip(*columns)))
+        expected = data.transform(x_new, None, contains_labels=False).x
+        transformed = preprocessor.transform_features(x_new)
+        self.assertTrue(np.allclose(expected, transformed))
+        export_folder = "__preprocessor__"
+        preprocessor.save(export_folder)
+        loaded = PreProcessor.load(export_folder, data=data)
+        self.assertTrue(np.allclose(expected, loaded.transform_features(x_new)))
+        os.remove(f"{export_folder}.zip")
+
+
+if __name__ == "__main__":
+    unittest.main()
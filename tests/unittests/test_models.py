@@ -0,0 +1,196 @@
+import os
+import time
+import torch
+import cflearn
+import unittest
+import threading
+
+import numpy as np
+
+from unittest import mock
+from cflearn.models import base
+from cflearn.misc.toolkit import to_torch
+from cflearn.modules.extractors import RNN
+from cflearn.modules.extractors import Transformer
+from cflearn.modules.transform.core import Dimensions
+
+
+class TestModels(unittest.TestCase):
+    def test_parallel_execute(self) -> None:
+        x = np.random.random([2000, 8])
+        x[..., 0] = np.random.randint(0, 5, 2000)
+        y = np.random.randint(0, 2, [2000, 1])
+        for model in ["tree_dnn", "wnd"]:
+            m = cflearn.make(
+                model,
+                task_type="clf",
+                max_epoch=1,
+                use_tqdm=False,
+                verbose_level=0,
+                model_config={"parallel_execute": True},
+            ).fit(x, y)
+            model_ins = m.model.eval()
+            split = model_ins.get_split(m.tr_data.processed.x, m.device)
+            timings = {}
+            outputs = {}
+            for parallel in [False, True]:
+                model_ins._parallel_execute = parallel
+                with torch.no_grad():
+                    t = time.time()
+                    for _ in range(20):
+                        outputs[parallel] = model_ins.execute(split)
+                    timings[parallel] = time.time() - t
+            sequential_t, parallel_t = timings[False], timings[True]
+            print(f"{model} | sequential : {sequential_t} ; parallel : {parallel_t}")
+            self.assertEqual(list(outputs[False]), list(outputs[True]))
+            for key, value in outputs[False].items():
+                self.assertTrue(torch.allclose(value, outputs[True][key]))
+            # thread pools belong to the instance and are not serialized
+            self.assertIsNotNone(model_ins._executor)
+            self.assertIsNone(model_ins.__getstate__()["_executor"])
+            model_ins.shutdown_executor()
+            self.assertIsNone(model_ins._executor)
+        cflearn._rmtree("_logs")
+
+    def test_compile_for_inference(self) -> None:
+        x = np.random.random([1000, 8])
+        x[..., 0] = np.random.randint(0, 5, 1000)
+        y = np.random.randint(0, 2, [1000, 1])
+        for model in ["fcnn", "tree_dnn"]:
+            m = cflearn.make(
+                model,
+                task_type="clf",
+                max_epoch=1,
+                use_tqdm=False,
+                verbose_level=0,
+            ).fit(x, y)
+            model_ins = m.model
+            x_batch = model_ins.input_sample["x_batch"].to(m.device)
+            with torch.no_grad():
+                traced = model_ins.compile_for_inference()
+                self.assertIsInstance(traced, torch.jit.ScriptModule)
+                # whole model tracing fails, so extractors & heads are traced instead
+                side_effect = RuntimeError("not traceable")
+                wrapper = base._InferenceWrapper
+                with mock.patch.object(wrapper, "forward", side_effect=side_effect):
+                    partial = model_ins.compile_for_inference()
+                self.assertNotIsInstance(partial, torch.jit.ScriptModule)
+            # compiled modules should not be bound to the batch size of the trace
+            x_all = to_torch(m.tr_data.processed.x).to(m.device)
+            for batch_size in [len(x_batch), 7, 300]:
+                x_local = x_all[:batch_size]
+                with torch.no_grad():
+                    expected = model_ins.eval()({"x_batch": x_local})
+                    outputs = traced(x_local)
+                    partial_outputs = partial(x_local)
+                for key, value in expected.items():
+                    self.assertTrue(torch.allclose(value, outputs[key], atol=1e-5))
+                    partial_value = partial_outputs[key]
+                    self.assertTrue(torch.allclose(value, partial_value, atol=1e-5))
+        cflearn._rmtree("_logs")
+
+    def test_transformer_streaming(self) -> None:
+        dim = 8
+        num_history = 5
+        batch_size = 4
+        dimensions = Dimensions(None, {i: i for i in range(dim)}, {}, num_history)
+
+        def _transformer(num_layers: int) -> Transformer:
+            return Transformer(
+                dim * num_history,
+                dimensions,
+                num_heads=2,
+                num_layers=num_layers,
+                latent_dim=16,
+                norm=None,
+                input_linear_config={"bias": False},
+                transformer_layer_config={"dropout": 0.0, "latent_dim": 32},
+            ).eval()
+
+        transformer = _transformer(1)
+        net = torch.randn(batch_size, 20, dim)
+        stream_state: dict = {}
+        with torch.no_grad():
+            for i in range(net.shape[1]):
+                streamed = transformer(net[:, i : i + 1], stream_state)
+                window = net[:, max(0, i - num_history + 1) : i + 1]
+                expected = transformer(window)
+                self.assertTrue(torch.allclose(streamed, expected, atol=1e-5))
+        cached_k = stream_state["kv_caches"][0]["k"]
+        self.assertEqual(cached_k.shape[1], num_history - 1)
+        deep_transformer = _transformer(2)
+        self.assertFalse(deep_transformer.supports_streaming)
+        with self.assertRaises(ValueError):
+            deep_transformer(net[:, :1], {})
+
+    def test_rnn_streaming(self) -> None:
+        dim = 8
+        batch_size = 4
+        dimensions = Dimensions(None, {i: i for i in range(dim)}, {}, 5)
+        for cell in ["GRU", "LSTM"]:
+            rnn = RNN(
+                dim * 5,
+                dimensions,
+                cell,
+                {"batch_first": True, "hidden_size": 16},
+                num_layers=2,
+            ).eval()
+            net = torch.randn(batch_size, 20, dim)
+            with torch.no_grad():
+                expected = rnn(net)
+                # states are carried per series, in a shuffled order
+                states = [None] * batch_size
+                for i in range(net.shape[1]):
+                    order = np.random.permutation(batch_size).tolist()
+                    merged = {}
+                    if states[0] is not None:
+                        merged = base._merge_states([states[j] for j in order])
+                    streamed = rnn(net[order, i : i + 1], merged)
+                    for k, j in enumerate(order):
+                        states[j] = base._split_state(merged, k)
+            restored = torch.empty_like(streamed)
+            restored[order] = streamed
+            self.assertTrue(torch.allclose(expected, restored, atol=1e-5))
+            signature = base._state_signature(states[0])
+            self.assertEqual(signature, base._state_signature(states[1]))
+
+    def test_async_checkpoint(self) -> None:
+        x = np.random.random([1000, 8])
+        y = np.random.random([1000, 1])
+        m = cflearn.make(
+            "fcnn",
+            max_epoch=5,
+            max_snapshot_file=2,
+            use_tqdm=False,
+            verbose_level=0,
+            trainer_config={"async_checkpoint": True},
+        ).fit(x, y)
+        trainer = m.trainer
+        folder = trainer.checkpoint_folder
+        files = os.listdir(folder)
+        self.assertFalse([file for file in files if file.endswith(".tmp")])
+        checkpoints = m.model.sorted_checkpoints(folder)
+        self.assertTrue(0 < len(checkpoints) <= 2)
+        self.assertEqual(set(checkpoints), set(trainer.checkpoint_scores))
+        for checkpoint in checkpoints:
+            self.assertIn(checkpoint, files)
+        # pending snapshots are coalesced, and restoring waits for the writer
+        writer = trainer._checkpoint_writer
+        written = []
+        started = threading.Event()
+
+        def _slow_task() -> None:
+            started.set()
+            time.sleep(0.2)
+
+        writer.submit(_slow_task)
+        started.wait()
+        for i in range(3):
+            writer.submit(lambda i=i: written.append(i))
+        self.assertTrue(trainer.restore_checkpoint())
+        self.assertEqual(written, [2])
+        cflearn._rmtree("_logs")
+
+
+if __name__ == "__main__":
+    unittest.main()